@@ -1,11 +1,23 @@
 import sys
+import multiprocessing
 from gui import OfficeToolsApp
+from single_instance import InstanceServer, notify_running
 import tkinter as tk
 
 def main():
+    # A window is already open: raise it instead of starting a second app
+    if notify_running():
+        return
     root = tk.Tk()
     app = OfficeToolsApp(root)
-    root.mainloop()
+    server = InstanceServer(lambda message: root.after(0, app.bring_to_front))
+    server.start()
+    try:
+        root.mainloop()
+    finally:
+        server.close()
 
 if __name__ == "__main__":
+    # Required for the PDF worker pool in frozen (PyInstaller) builds
+    multiprocessing.freeze_support()
     main()
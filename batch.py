@@ -0,0 +1,216 @@
+"""
+Headless batch compressor.
+
+Compresses every pdf/docx/xlsx matched by the given files, directories or glob
+patterns on a bounded worker pool and writes a per-file JSON or CSV report.
+Never imports tkinter, so it runs on servers without a display.
+
+    python batch.py ./incoming "scans/**/*.pdf" --target-kb 500 --jobs 8 \
+        --output-dir ./compressed --report report.json
+"""
+import os
+import sys
+import csv
+import glob
+import json
+import time
+import argparse
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import compressor
+from compressor import (COMPRESSIBLE_TYPES, DEFAULT_RESAMPLE, PIXEL_CACHE_BYTES, RESAMPLE_FILTERS,
+                        SEARCH_MODES, compress_file, get_file_size_mb)
+from result_cache import RESULT_CACHE_BYTES, ResultCache
+
+REPORT_FIELDS = ["input", "output", "file_type", "status", "original_kb", "final_kb",
+                 "target_kb", "estimated_min_kb", "quality", "scale", "trials", "converged", "cache_hit",
+                 "wall_time_s", "error"]
+
+def _glob_base(pattern):
+    """
+    Leading directories of a glob pattern that hold no wildcards ("" for none).
+    """
+    while glob.has_magic(pattern):
+        pattern = os.path.dirname(pattern)
+    return pattern
+
+def _unique_name(rel_path, taken):
+    # Output names are compared case-insensitively, as on Windows file systems
+    stem, ext = os.path.splitext(rel_path)
+    name, n = rel_path, 1
+    while os.path.normcase(name).lower() in taken:
+        n += 1
+        name = f"{stem}-{n}{ext}"
+    taken.add(os.path.normcase(name).lower())
+    return name
+
+def collect_inputs(sources, recursive=True):
+    """
+    Expands files, directories and glob patterns into (path, relative output name) pairs.
+    Directory contents keep their layout relative to the directory, and glob matches
+    relative to the pattern's leading directories without wildcards. Inputs that
+    would still share an output name get a -2, -3, ... suffix.
+    """
+    found = {}
+    for source in sources:
+        if os.path.isdir(source):
+            pattern = os.path.join(source, "**", "*") if recursive else os.path.join(source, "*")
+            for path in glob.glob(pattern, recursive=recursive):
+                found.setdefault(os.path.abspath(path), os.path.relpath(path, source))
+        elif glob.has_magic(source):
+            base = _glob_base(source) or os.curdir
+            for path in glob.glob(source, recursive=True):
+                found.setdefault(os.path.abspath(path), os.path.relpath(path, base))
+        else:
+            found.setdefault(os.path.abspath(source), os.path.basename(source))
+    inputs = sorted((path, rel) for path, rel in found.items()
+                    if os.path.isfile(path)
+                    and os.path.splitext(path)[1][1:].lower() in COMPRESSIBLE_TYPES)
+    taken = set()
+    return [(path, _unique_name(rel, taken)) for path, rel in inputs]
+
+def output_path_for(rel_path, output_dir, suffix):
+    stem, ext = os.path.splitext(rel_path)
+    return os.path.join(output_dir, f"{stem}{suffix}{ext}")
+
+def run_job(input_path, output_path, target_mb, cache_dir=None, cache_bytes=RESULT_CACHE_BYTES,
+            time_budget=None, mode="standard", resample=DEFAULT_RESAMPLE, memory_limit=None,
+            pixel_budget=PIXEL_CACHE_BYTES):
+    """
+    Compresses one file and returns its report row. Errors are reported, not raised.
+    """
+    started = time.perf_counter()
+    row = dict.fromkeys(REPORT_FIELDS)
+    row.update(input=input_path, output=output_path, target_kb=round(target_mb * 1024, 1))
+    try:
+        os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+        cache = ResultCache(cache_dir, cache_bytes) if cache_dir else None
+        # Jobs already run one per process: PDFs stay on the thread engine, which
+        # _init_worker sized to this worker's share of the cores
+        result = compress_file(input_path, output_path, target_mb, processes=1, result_cache=cache,
+                               time_budget=time_budget, mode=mode, resample=resample,
+                               memory_limit=memory_limit, pixel_budget=pixel_budget)
+        row.update(file_type=result.file_type, status=result.status,
+                   original_kb=round(result.original_size_mb * 1024, 1),
+                   final_kb=round(result.final_size_mb * 1024, 1),
+                   quality=result.quality, scale=result.scale, trials=result.trials,
+                   converged=result.converged, cache_hit=result.cache_hit)
+        if result.estimated_min_mb is not None:
+            row["estimated_min_kb"] = round(result.estimated_min_mb * 1024, 1)
+    except Exception as e:
+        row.update(status="error", error=str(e),
+                   original_kb=round(get_file_size_mb(input_path) * 1024, 1))
+    row["wall_time_s"] = round(time.perf_counter() - started, 3)
+    return row
+
+def write_report(rows, report_path):
+    """
+    Writes report rows as CSV when report_path ends in .csv, JSON otherwise.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(report_path)), exist_ok=True)
+    if report_path.lower().endswith(".csv"):
+        with open(report_path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=REPORT_FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+    else:
+        with open(report_path, "w", encoding="utf-8") as f:
+            json.dump(rows, f, indent=2)
+
+def _init_worker(threads):
+    # Runs before any job, so the worker's shared executor is built at this size
+    compressor.SHARED_WORKERS = threads
+
+def run_batch(jobs, target_mb, workers, cache_dir=None, cache_bytes=RESULT_CACHE_BYTES,
+              time_budget=None, mode="standard", resample=DEFAULT_RESAMPLE, memory_limit=None,
+              pixel_budget=None):
+    """
+    Runs (input, output) jobs on a pool of at most `workers` processes.
+    `pixel_budget` is per worker; by default PIXEL_CACHE_BYTES is split between them.
+    The cores are split between the workers' image threads the same way.
+    Returns report rows in input order.
+    """
+    workers = max(1, workers)
+    if pixel_budget is None:
+        pixel_budget = PIXEL_CACHE_BYTES // workers
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    rows = {}
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(threads,)) as executor:
+        futures = {executor.submit(run_job, src, dst, target_mb, cache_dir, cache_bytes,
+                                   time_budget, mode, resample, memory_limit, pixel_budget): src
+                   for src, dst in jobs}
+        for done, future in enumerate(as_completed(futures), 1):
+            row = future.result()
+            rows[futures[future]] = row
+            logging.info("[%d/%d] %s: %s (%s KB -> %s KB, %.1fs)", done, len(futures),
+                         row["input"], row["status"], row["original_kb"], row["final_kb"],
+                         row["wall_time_s"])
+    return [rows[src] for src, _ in jobs]
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Compress pdf/docx/xlsx files in bulk.")
+    parser.add_argument("inputs", nargs="+", help="Files, directories or glob patterns")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--target-kb", type=float, help="Target size per file in KB")
+    target.add_argument("--target-mb", type=float, help="Target size per file in MB")
+    parser.add_argument("-o", "--output-dir", default="compressed",
+                        help="Directory for compressed files (default: ./compressed)")
+    parser.add_argument("--suffix", default="_compressed",
+                        help="Suffix added to output file names (default: _compressed)")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1,
+                        help="Files compressed in parallel (default: CPU count)")
+    parser.add_argument("--report", default=None,
+                        help="Report path, .json or .csv (default: <output-dir>/report.json)")
+    parser.add_argument("--mode", choices=SEARCH_MODES, default="standard",
+                        help="Search mode; perceptual modes apply to docx/xlsx (default: standard)")
+    parser.add_argument("--resample", choices=sorted(RESAMPLE_FILTERS), default=DEFAULT_RESAMPLE,
+                        help="Filter for downscaled images; bilinear/box trade sharpness for speed "
+                             "(default: %(default)s)")
+    parser.add_argument("--memory-limit-mb", type=float, default=None,
+                        help="Stream PDFs from disk, holding at most this much decoded image data "
+                             "per worker")
+    parser.add_argument("--pixel-cache-mb", type=float, default=None,
+                        help="Decoded images kept across search trials, per worker; 0 decodes "
+                             f"every trial (default: {PIXEL_CACHE_BYTES // (1024 * 1024)} split "
+                             "across --jobs)")
+    parser.add_argument("--time-budget", type=float, default=None,
+                        help="Seconds per file; the best result found in time is kept")
+    parser.add_argument("--cache-dir", default=None,
+                        help="Shared result cache directory; repeat inputs are served from it")
+    parser.add_argument("--cache-size-mb", type=float, default=RESULT_CACHE_BYTES / (1024 * 1024),
+                        help="Result cache size cap in MB (default: %(default)d)")
+    parser.add_argument("--no-recursive", action="store_true",
+                        help="Do not descend into subdirectories of input directories")
+    parser.add_argument("-q", "--quiet", action="store_true", help="Only log errors")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.ERROR if args.quiet else logging.INFO,
+                        format="%(asctime)s %(message)s", stream=sys.stderr)
+    target_mb = args.target_mb if args.target_mb is not None else args.target_kb / 1024.0
+
+    inputs = collect_inputs(args.inputs, recursive=not args.no_recursive)
+    if not inputs:
+        logging.error("No pdf/docx/xlsx files matched %s", " ".join(args.inputs))
+        return 2
+    jobs = [(path, output_path_for(rel, args.output_dir, args.suffix)) for path, rel in inputs]
+
+    memory_limit = int(args.memory_limit_mb * 1024 * 1024) if args.memory_limit_mb else None
+    pixel_budget = int(args.pixel_cache_mb * 1024 * 1024) if args.pixel_cache_mb is not None else None
+    rows = run_batch(jobs, target_mb, args.jobs, args.cache_dir,
+                     int(args.cache_size_mb * 1024 * 1024), args.time_budget, args.mode, args.resample,
+                     memory_limit, pixel_budget)
+    report_path = args.report or os.path.join(args.output_dir, "report.json")
+    write_report(rows, report_path)
+
+    errors = sum(row["status"] == "error" for row in rows)
+    logging.info("Processed %d files (%d errors). Report: %s", len(rows), errors, report_path)
+    return 1 if errors else 0
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -0,0 +1,380 @@
+"""
+Compression benchmark suite.
+
+Builds a reproducible synthetic corpus (photo-like images, many-image docx, xlsx
+with charts, multi-hundred-page PDFs with shared XObjects), times the compressor
+per phase and saves the numbers as JSON so runs can be compared across commits.
+
+    python benchmark.py --output bench/HEAD.json
+    python benchmark.py --quick --compare bench/HEAD.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import zipfile
+import argparse
+import io
+import platform
+import tempfile
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+
+from compressor import (RESAMPLE_FILTERS, PdfImageIndex, compress_file, compress_pdf, encode_image,
+                        parallel_compress_images)
+from test_compression import create_test_image, create_test_pdf, create_test_docx, create_test_xlsx
+
+# name: (builder, builder kwargs, target as a fraction of the original size)
+CORPUS = {
+    "docx_many_images": ("docx", {"images": 24, "size": (1600, 1200)}, 0.3),
+    "docx_24mp_photos": ("docx", {"images": 4, "size": (6000, 4000)}, 0.15),
+    "xlsx_charts": ("xlsx", {"images": 6, "size": (1200, 900), "charts": 8}, 0.4),
+    "pdf_shared_xobjects": ("pdf", {"images": 6, "size": (1400, 1000), "pages": 300, "shared": True}, 0.4),
+    "pdf_scanned_pages": ("pdf", {"images": 120, "size": (1240, 1754), "pages": 120, "shared": False}, 0.4),
+}
+QUICK_CORPUS = {
+    "docx_many_images": ("docx", {"images": 6, "size": (800, 600)}, 0.3),
+    "docx_24mp_photos": ("docx", {"images": 2, "size": (3000, 2000)}, 0.15),
+    "xlsx_charts": ("xlsx", {"images": 3, "size": (800, 600), "charts": 2}, 0.4),
+    "pdf_shared_xobjects": ("pdf", {"images": 3, "size": (800, 600), "pages": 60, "shared": True}, 0.4),
+    "pdf_scanned_pages": ("pdf", {"images": 12, "size": (620, 877), "pages": 12, "shared": False}, 0.4),
+}
+
+def peak_rss_mb():
+    """
+    Peak resident set size of the current process in MB, or None if unavailable.
+    """
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+    except ImportError:
+        pass
+    try:
+        import psutil
+        info = psutil.Process().memory_info()
+        return getattr(info, "peak_wset", info.rss) / (1024 * 1024)
+    except ImportError:
+        return None
+
+def build_corpus(corpus_dir, spec):
+    """
+    Generates the corpus files described by `spec` into corpus_dir (seeded, so every
+    run produces identical inputs). Returns {case name: path}.
+    """
+    os.makedirs(corpus_dir, exist_ok=True)
+    paths = {}
+    for name, (kind, opts, _) in spec.items():
+        path = os.path.join(corpus_dir, f"{name}.{kind}")
+        paths[name] = path
+        if os.path.exists(path):
+            continue
+        images = []
+        for n in range(opts["images"]):
+            image_path = os.path.join(corpus_dir, f"{name}_img{n}.jpeg")
+            create_test_image(image_path, size=opts["size"], noise=True, seed=n)
+            images.append(image_path)
+        if kind == "docx":
+            create_test_docx(path, images, paragraphs=200)
+        elif kind == "xlsx":
+            create_test_xlsx(path, images, charts=opts["charts"])
+        else:
+            create_test_pdf(path, images, pages=opts["pages"], shared=opts["shared"])
+        for image_path in images:
+            os.remove(image_path)
+    return paths
+
+def _bench_iterative(path, fraction, work_dir):
+    target_mb = os.path.getsize(path) * fraction / (1024 * 1024)
+    output_path = os.path.join(work_dir, "out" + os.path.splitext(path)[1])
+    result = compress_file(path, output_path, target_mb)
+    return {
+        "original_kb": round(result.original_size_mb * 1024, 1),
+        "final_kb": round(result.final_size_mb * 1024, 1),
+        "target_kb": round(target_mb * 1024, 1),
+        "found_fit": result.found_fit,
+        "quality": result.quality,
+        "scale": result.scale,
+        "trials": result.trials,
+        "wall_time_s": round(result.elapsed, 4),
+        "phases_s": {name: round(seconds, 4) for name, seconds in result.phases.items()},
+    }
+
+def _phase_recorder(phases):
+    """
+    Progress callback that adds up the "phase" events of a compress_pdf call in
+    `phases` ({name: seconds}), as compress_file does for result.phases.
+    """
+    def progress(event):
+        if event["event"] == "phase":
+            phases[event["phase"]] = phases.get(event["phase"], 0.0) + event["seconds"]
+    return progress
+
+def _bench_compress_pdf(path, work_dir):
+    phases = {}
+    started = time.perf_counter()
+    compress_pdf(path, os.path.join(work_dir, "single.pdf"), quality=60, scale=0.75,
+                 progress=_phase_recorder(phases))
+    return {"wall_time_s": round(time.perf_counter() - started, 4),
+            "phases_s": {name: round(seconds, 4) for name, seconds in phases.items()}}
+
+def _timed_compress_pdf(path, output_path, memory_limit):
+    phases = {}
+    started = time.perf_counter()
+    compress_pdf(path, output_path, quality=60, scale=0.75, processes=1, memory_limit=memory_limit,
+                 progress=_phase_recorder(phases))
+    return {"wall_time_s": round(time.perf_counter() - started, 4), "peak_rss_mb": peak_rss_mb(),
+            "phases_s": {name: round(seconds, 4) for name, seconds in phases.items()}}
+
+def _bench_pdf_memory(path, work_dir, memory_limit=64 * 1024 * 1024):
+    """
+    Peak RSS and wall time of compress_pdf in memory and in streaming mode, each
+    measured in a fresh process.
+    """
+    results = {}
+    for name, limit in (("in_memory", None), ("streaming", memory_limit)):
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            results[name] = executor.submit(_timed_compress_pdf, path,
+                                            os.path.join(work_dir, f"{name}.pdf"), limit).result()
+    return results
+
+# (quality, scale) of the trials timed per PDF engine
+ENGINE_TRIALS = ((70, 1.0), (50, 0.75), (40, 0.5))
+
+def _timed_pdf_engine(path, processes):
+    started = time.perf_counter()
+    with PdfImageIndex(path, processes=processes) as index:
+        loaded = time.perf_counter()
+        for quality, scale in ENGINE_TRIALS:
+            index.render(quality, scale)
+        finished = time.perf_counter()
+        engine = "processes" if index._pool is not None else "threads"
+    return {"engine": engine, "images": len(index.images), "load_s": round(loaded - started, 4),
+            "trial_s": round((finished - loaded) / len(ENGINE_TRIALS), 4)}
+
+def _bench_pdf_engines(path):
+    """
+    Load time (pool start-up included) and mean trial time of the threaded PDF
+    engine against the process engine at 2 and at cpu_count workers, each in a
+    fresh process. These are the numbers behind PdfImageIndex's engine choice.
+    """
+    results = {}
+    for processes in sorted({1, 2, max(2, os.cpu_count() or 1)}):
+        name = "threads" if processes == 1 else f"processes_{processes}"
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            results[name] = executor.submit(_timed_pdf_engine, path, processes).result()
+    return results
+
+def _bench_parallel_images(path, work_dir):
+    media_dir = os.path.join(work_dir, "extract")
+    started = time.perf_counter()
+    with zipfile.ZipFile(path) as zf:
+        zf.extractall(media_dir)
+    media_dirs = [root for root, _, _ in os.walk(media_dir) if root.endswith("media")]
+    extracted = time.perf_counter()
+    for m_dir in media_dirs:
+        parallel_compress_images(m_dir, 60, 0.75)
+    finished = time.perf_counter()
+    return {"wall_time_s": round(finished - started, 4), "extract_s": round(extracted - started, 4),
+            "compress_s": round(finished - extracted, 4)}
+
+def _bench_downscale(path, scales=(0.5, 0.25)):
+    """
+    Times re-encoding the package's JPEG media at each scale: the old full-resolution
+    decode + LANCZOS resize against the reduced-resolution decode with each filter.
+    """
+    with zipfile.ZipFile(path) as zf:
+        images = [zf.read(name) for name in zf.namelist() if name.lower().endswith((".jpg", ".jpeg"))]
+    results = {}
+    for scale in scales:
+        started = time.perf_counter()
+        for data in images:
+            with Image.open(io.BytesIO(data)) as img:
+                size = (int(img.width * scale), int(img.height * scale))
+                img.resize(size, Image.Resampling.LANCZOS).save(io.BytesIO(), "JPEG", quality=70, optimize=True)
+        timings = {"full_decode_lanczos": round(time.perf_counter() - started, 4)}
+        for name in RESAMPLE_FILTERS:
+            started = time.perf_counter()
+            for data in images:
+                encode_image(data, 70, scale, resample=name)
+            timings[f"draft_{name}"] = round(time.perf_counter() - started, 4)
+        results[str(scale)] = timings
+    return results
+
+# Runs in a fresh interpreter: import time of the GUI and time to its first drawn window
+_STARTUP_PROBE = """
+import sys, time, json, tempfile
+state_dir = tempfile.mkdtemp()
+# The single-instance check every launch makes first, with no instance running
+started = time.perf_counter()
+from single_instance import notify_running
+notify_running(state_dir=state_dir)
+instance_check_s = time.perf_counter() - started
+started = time.perf_counter()
+import gui
+result = {"import_gui_s": time.perf_counter() - started, "instance_check_s": instance_check_s,
+          "heavy_modules_at_startup": sorted(m for m in ("PIL", "pypdf", "pdf2docx", "compressor") if m in sys.modules)}
+started = time.perf_counter()
+import compressor
+result["import_compressor_s"] = time.perf_counter() - started
+try:
+    root = gui.tk.Tk()
+except gui.tk.TclError:
+    result["first_window_s"] = None  # no display
+else:
+    started = time.perf_counter()
+    gui.OfficeToolsApp(root)
+    root.update()
+    result["first_window_s"] = result["import_gui_s"] + time.perf_counter() - started
+    root.destroy()
+print(json.dumps(result))
+"""
+
+def bench_startup(repeats=3):
+    """
+    Cold-start metrics, best of `repeats` fresh interpreters: process wall time, the
+    single-instance check, GUI import time, the deferred compressor import and time
+    to the first window (None without a display). heavy_modules_at_startup lists libraries the GUI loaded eagerly.
+    """
+    runs = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        proc = subprocess.run([sys.executable, "-c", _STARTUP_PROBE], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+        run = json.loads(proc.stdout.strip().splitlines()[-1])
+        run["process_s"] = time.perf_counter() - started
+        runs.append(run)
+    best = {"heavy_modules_at_startup": runs[-1]["heavy_modules_at_startup"]}
+    for key in ("process_s", "instance_check_s", "import_gui_s", "import_compressor_s", "first_window_s"):
+        values = [run[key] for run in runs if run[key] is not None]
+        best[key] = round(min(values), 4) if values else None
+    return best
+
+def run_case(name, path, fraction):
+    """
+    Runs every benchmark for one corpus file. Meant to run in a fresh process so
+    peak RSS belongs to this case alone.
+    """
+    work_dir = tempfile.mkdtemp(prefix="office_tools_bench_")
+    try:
+        metrics = {"file": os.path.basename(path), "iterative_compress": _bench_iterative(path, fraction, work_dir)}
+        if path.endswith(".pdf"):
+            metrics["compress_pdf"] = _bench_compress_pdf(path, work_dir)
+            metrics["compress_pdf_memory"] = _bench_pdf_memory(path, work_dir)
+            metrics["pdf_engines"] = _bench_pdf_engines(path)
+        else:
+            metrics["parallel_compress_images"] = _bench_parallel_images(path, work_dir)
+            metrics["downscale_s"] = _bench_downscale(path)
+        metrics["peak_rss_mb"] = peak_rss_mb()
+        return metrics
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def run_suite(spec, corpus_dir, cases=None):
+    paths = build_corpus(corpus_dir, spec)
+    results = {}
+    for name, path in paths.items():
+        if cases and name not in cases:
+            continue
+        # One process per case: isolates peak RSS and warm caches between cases
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            results[name] = executor.submit(run_case, name, path, spec[name][2]).result()
+        print(f"{name}: {results[name]['iterative_compress']['wall_time_s']:.2f}s, "
+              f"{results[name]['iterative_compress']['trials']} trials", file=sys.stderr)
+    return {
+        "meta": {
+            "revision": git_revision(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "results": results,
+        "startup": bench_startup(),
+    }
+
+def compare(current, baseline):
+    """
+    Prints wall time, trials and peak RSS of two runs side by side.
+    """
+    print(f"{'case':<24}{'time (s)':>20}{'trials':>12}{'peak RSS (MB)':>22}")
+    for name, now in current["results"].items():
+        before = baseline.get("results", {}).get(name)
+        if before is None:
+            continue
+        t0, t1 = before["iterative_compress"]["wall_time_s"], now["iterative_compress"]["wall_time_s"]
+        speedup = f"x{t0 / t1:.2f}" if t1 else "-"
+        print(f"{name:<24}{t0:>7.2f} -> {t1:<6.2f}{speedup:>6}"
+              f"{before['iterative_compress']['trials']:>5} -> {now['iterative_compress']['trials']:<4}"
+              f"{before['peak_rss_mb'] or 0:>9.0f} -> {now['peak_rss_mb'] or 0:<8.0f}")
+    before, now = baseline.get("startup"), current.get("startup")
+    if before and now:
+        for key in ("instance_check_s", "import_gui_s", "first_window_s", "process_s"):
+            if before.get(key) is not None and now.get(key) is not None:
+                print(f"startup {key}: {before[key]:.3f}s -> {now[key]:.3f}s")
+        if now["heavy_modules_at_startup"]:
+            print(f"startup imports eagerly: {', '.join(now['heavy_modules_at_startup'])}")
+    for name, now in current["results"].items():
+        single = now.get("compress_pdf")
+        if single and single.get("phases_s"):
+            print(f"{name}: compress_pdf " + ", ".join(f"{phase} {seconds:.2f}s"
+                                                       for phase, seconds in single["phases_s"].items()))
+        memory = now.get("compress_pdf_memory")
+        if memory:
+            print(f"{name}: compress_pdf peak RSS {memory['in_memory']['peak_rss_mb'] or 0:.0f} MB in memory, "
+                  f"{memory['streaming']['peak_rss_mb'] or 0:.0f} MB streaming")
+        engines = now.get("pdf_engines")
+        if engines:
+            print(f"{name}: " + ", ".join(f"{engine} {timing['load_s']:.2f}s load + {timing['trial_s']:.2f}s/trial"
+                                          for engine, timing in engines.items()))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Office Tools compressor.")
+    parser.add_argument("--quick", action="store_true", help="Small corpus for a fast smoke run")
+    parser.add_argument("--corpus-dir", default=None,
+                        help="Keep the generated corpus here and reuse it across runs")
+    parser.add_argument("--case", action="append", dest="cases", help="Only run this case (repeatable)")
+    parser.add_argument("--output", default=None, help="Write results as JSON to this path")
+    parser.add_argument("--compare", default=None, help="Previous results JSON to compare against")
+    parser.add_argument("--startup-only", action="store_true",
+                        help="Only measure cold start (import time, time to first window)")
+    args = parser.parse_args(argv)
+
+    if args.startup_only:
+        json.dump({"startup": bench_startup()}, sys.stdout, indent=2)
+        print()
+        return 0
+
+    spec = QUICK_CORPUS if args.quick else CORPUS
+    corpus_dir = args.corpus_dir or tempfile.mkdtemp(prefix="office_tools_corpus_")
+    try:
+        report = run_suite(spec, corpus_dir, args.cases)
+    finally:
+        if not args.corpus_dir:
+            shutil.rmtree(corpus_dir, ignore_errors=True)
+    report["meta"]["corpus"] = "quick" if args.quick else "full"
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(report, json.load(f))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,175 +1,2297 @@
 import os
+import io
+import re
+import math
 import zipfile
 import shutil
-import tempfile
+import struct
+import zlib
+import posixpath
 import logging
+import hashlib
+import threading
+import tempfile
+import time
+import itertools
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, field, asdict
+from collections import OrderedDict
 from PIL import Image
 from pypdf import PdfReader, PdfWriter
-from concurrent.futures import ThreadPoolExecutor
+from pypdf.generic import DictionaryObject, IndirectObject, NameObject, NumberObject, StreamObject
+try:
+    from pypdf.generic._image_xobject import _xobj_to_image
+except ImportError:  # pypdf < 5
+    from pypdf.filters import _xobj_to_image
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from result_cache import file_digest
 
 # Silence pypdf log messages
 logging.getLogger("pypdf").setLevel(logging.ERROR)
 
-def compress_pdf(input_path, output_path, quality=None, scale=1.0):
+MEDIA_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.tif', '.tiff')
+
+# Resampling filters for downscaled trials: LANCZOS is the sharpest, BILINEAR and BOX
+# the fastest. Integer factors are taken with Image.reduce first, so the chosen
+# filter only covers the last step of at most REDUCING_GAP.
+RESAMPLE_FILTERS = {
+    "lanczos": Image.Resampling.LANCZOS,
+    "bicubic": Image.Resampling.BICUBIC,
+    "bilinear": Image.Resampling.BILINEAR,
+    "box": Image.Resampling.BOX,
+}
+DEFAULT_RESAMPLE = "lanczos"
+REDUCING_GAP = 3.0
+
+# Memory cap for encoded images memoized during a size search
+ENCODE_CACHE_BYTES = 256 * 1024 * 1024
+# Memory cap for decoded originals and their downscaled levels (see PixelCache)
+PIXEL_CACHE_BYTES = 512 * 1024 * 1024
+
+class CompressionCancelled(Exception):
     """
-    Compresses a PDF file by reducing image quality and content stream compression.
+    Raised when a CancelToken is triggered while a compression is running.
     """
-    with open(input_path, "rb") as in_f:
-        reader = PdfReader(in_f, strict=False)
-        writer = PdfWriter()
 
-        for page in reader.pages:
-            writer.add_page(page)
+class CancelToken:
+    """
+    Cooperative cancellation flag, checked between images and between trials.
+    """
+    def __init__(self):
+        self._event = threading.Event()
 
-        for page in writer.pages:
-            for img in page.images:
-                try:
-                    pil_img = img.image
-                    if scale < 1.0:
-                        new_size = (max(1, int(pil_img.width * scale)), max(1, int(pil_img.height * scale)))
-                        pil_img = pil_img.resize(new_size, Image.Resampling.LANCZOS)
-                    img.replace(pil_img, quality=quality) if quality else None
-                except:
-                    pass
-            page.compress_content_streams()
+    def cancel(self):
+        self._event.set()
 
-        with open(output_path, "wb") as out_f:
-            writer.write(out_f)
+    @property
+    def cancelled(self):
+        return self._event.is_set()
 
-def compress_image(image_path, quality=70, scale=1.0):
+    def raise_if_cancelled(self):
+        if self._event.is_set():
+            raise CompressionCancelled("Compression cancelled")
+
+class _DeadlineReached(Exception):
     """
-    Compresses a single image file with optional scaling.
+    Internal: the time budget of a compress_file call ran out.
+    """
+
+class _DeadlineToken:
+    """
+    Cancel token that also fires when time.monotonic() passes `deadline`.
+    User cancellation still raises CompressionCancelled; the deadline raises
+    _DeadlineReached so the search can finish with its best result so far.
+    """
+    def __init__(self, deadline, parent=None):
+        self.deadline = deadline
+        self.parent = parent
+
+    @property
+    def cancelled(self):
+        return (self.parent is not None and self.parent.cancelled) or time.monotonic() >= self.deadline
+
+    def raise_if_cancelled(self):
+        _check_cancel(self.parent)
+        if time.monotonic() >= self.deadline:
+            raise _DeadlineReached()
+
+def _check_cancel(cancel):
+    if cancel is not None:
+        cancel.raise_if_cancelled()
+
+def _emit(progress, event, **fields):
+    """
+    Sends one structured event ({"event": name, ...}) to a progress callback.
+    """
+    if progress is not None:
+        fields["event"] = event
+        progress(fields)
+
+def _image_counter(on_image, total):
     """
+    Returns a thread-safe callable reporting on_image(done, total) once per encoded image.
+    """
+    if on_image is None:
+        return lambda: None
+    counter = itertools.count(1)
+    lock = threading.Lock()
+    def tick():
+        with lock:
+            on_image(next(counter), total)
+    return tick
+
+# Threads in the shared executor. Encoders and zlib release the GIL, so one per core
+# keeps every core busy however many jobs are running.
+SHARED_WORKERS = os.cpu_count() or 1
+_shared_executor = None
+_shared_lock = threading.Lock()
+_shared_thread = threading.local()
+
+def _mark_shared_thread():
+    _shared_thread.active = True
+
+def _reset_shared_executor():
+    # A forked child inherits the pool object but not its threads
+    global _shared_executor, _shared_lock
+    _shared_executor = None
+    _shared_lock = threading.Lock()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_shared_executor)
+
+def shared_executor():
+    """
+    The process-wide thread pool behind parallel_map, created on first use.
+    """
+    global _shared_executor
+    with _shared_lock:
+        if _shared_executor is None:
+            _shared_executor = ThreadPoolExecutor(max_workers=SHARED_WORKERS, thread_name_prefix="office_tools",
+                                                  initializer=_mark_shared_thread)
+        return _shared_executor
+
+def parallel_map(fn, items, max_workers=None):
+    """
+    Returns [fn(item) for item in items], computed on the shared executor, or on a
+    private pool when `max_workers` is given. Calls made from a shared pool thread
+    run inline, so a task never waits for a pool it occupies. When a call raises,
+    the tasks that have not started are cancelled.
+    """
+    items = list(items)
+    if len(items) <= 1 or getattr(_shared_thread, "active", False):
+        return [fn(item) for item in items]
+    if max_workers is not None:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(fn, items))
+    futures = [shared_executor().submit(fn, item) for item in items]
     try:
-        with Image.open(image_path) as img:
+        return [future.result() for future in futures]
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        raise
+
+# Below this many unique images a PDF is encoded on threads even when processes are asked
+# for: with 8 scans the process engine took 0.85 s per trial against 0.66 s on threads,
+# and it only drew level at 120 (benchmark.py pdf_engines)
+PDF_PROCESS_MIN_IMAGES = 16
+
+# Stream keys rewritten when an image XObject is replaced by a JPEG
+_PDF_IMAGE_KEYS = ("/Filter", "/DecodeParms", "/Decode", "/Width", "/Height",
+                   "/ColorSpace", "/BitsPerComponent")
+# Bi-level codecs compress scans far better than JPEG ever will
+_PDF_BILEVEL_FILTERS = ("/CCITTFaxDecode", "/JBIG2Decode")
+
+def _pdf_filters(obj):
+    filters = obj.get("/Filter")
+    if filters is None:
+        return []
+    return [filters] if isinstance(filters, str) else list(filters)
+
+def _is_replaceable_image(obj):
+    """
+    True for image XObjects that can be safely re-encoded as JPEG.
+    """
+    if obj.get("/Subtype") != "/Image" or obj.get("/ImageMask"):
+        return False
+    if obj.get("/BitsPerComponent") == 1 or isinstance(obj.get("/Mask"), list):
+        return False
+    return not any(f in _PDF_BILEVEL_FILTERS for f in _pdf_filters(obj))
+
+def _pdf_image_digest(obj):
+    """
+    Content hash of an image XObject: stream bytes plus every key that affects decoding.
+    """
+    h = hashlib.sha256(obj._data)
+    for key in _PDF_IMAGE_KEYS + ("/SMask", "/Mask"):
+        h.update(repr((key, obj.get(key))).encode())
+    return h.hexdigest()
+
+def _iter_image_xobjects(resources, visited):
+    """
+    Yields (xobject dict, name, reference, object) for every image XObject reachable
+    from a resources dictionary, descending into form XObjects once each.
+    """
+    if resources is None:
+        return
+    xobjects = resources.get_object().get("/XObject")
+    if xobjects is None:
+        return
+    xobjects = xobjects.get_object()
+    for name in list(xobjects.keys()):
+        ref = xobjects.raw_get(name)
+        obj = xobjects[name].get_object()
+        if obj.get("/Subtype") == "/Form":
+            key = ref.idnum if isinstance(ref, IndirectObject) else id(obj)
+            if key not in visited:
+                visited.add(key)
+                yield from _iter_image_xobjects(obj.get("/Resources"), visited)
+        elif obj.get("/Subtype") == "/Image":
+            yield xobjects, name, ref, obj
+
+def _scaled_size(width, height, scale):
+    return max(1, int(width * scale)), max(1, int(height * scale))
+
+def _draft(img, size):
+    """
+    Lets libjpeg decode a JPEG that is not loaded yet at the smallest DCT scale
+    (1/2, 1/4 or 1/8) that still covers `size`, instead of at full resolution.
+    """
+    if img.format == "JPEG" and img.mode in ("L", "RGB", "CMYK"):
+        img.draft(img.mode, size)
+
+def _downscale(img, size, resample=DEFAULT_RESAMPLE):
+    if img.size == size:
+        return img
+    return img.resize(size, RESAMPLE_FILTERS[resample], reducing_gap=REDUCING_GAP)
+
+def _pixel_bytes(img):
+    # Pillow keeps one byte per pixel for single-band images and four for the rest
+    return img.width * img.height * (1 if img.mode in ("1", "L", "P") else 4)
+
+class PixelCache:
+    """
+    Thread-safe LRU cache of decoded originals and their downscaled levels, so a
+    search decodes each image once and resizes it once per scale, however many
+    trials and qualities it tries.
+
+    Levels are keyed by (image key, scale, resample filter) and always built from
+    the full-resolution level. For JPEGs that differs slightly from the uncached
+    path, which decodes at a reduced DCT scale (_draft) before resizing; other
+    formats match it exactly. Pixel buffers are kept under max_bytes by evicting
+    least recently used levels; max_bytes=0 disables the cache.
+    """
+    def __init__(self, max_bytes=PIXEL_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.decodes = 0
+        self.hits = 0
+        self._levels = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        with self._lock:
+            img = self._levels.get(key)
+            if img is not None:
+                self._levels.move_to_end(key)
+                self.hits += 1
+            return img
+
+    def _put(self, key, img):
+        size = _pixel_bytes(img)
+        with self._lock:
+            if key not in self._levels:
+                self._levels[key] = img
+                self.current_bytes += size
+            while self.current_bytes > self.max_bytes and len(self._levels) > 1:
+                _, evicted = self._levels.popitem(last=False)
+                self.current_bytes -= _pixel_bytes(evicted)
+
+    def level(self, key, size, scale, resample, decode):
+        """
+        Returns the image `key` (full size `size`) at `scale`. `decode()` must return
+        the loaded full-resolution image and is only called when that level is not
+        cached. Returns None, without decoding, when the full-resolution image
+        alone would exceed the budget; the caller then uses its uncached path.
+        """
+        if size[0] * size[1] * 4 > self.max_bytes:
+            return None
+        if scale >= 1.0:
+            resample = None
+        img = self._get((key, scale, resample))
+        if img is not None:
+            return img
+        base = self._get((key, 1.0, None))
+        if base is None:
+            base = decode()
+            base.load()
+            self.decodes += 1
+            self._put((key, 1.0, None), base)
+        if scale >= 1.0:
+            return base
+        img = _downscale(base, _scaled_size(base.width, base.height, scale), resample)
+        self._put((key, scale, resample), img)
+        return img
+
+def _open_pdf_image(source, scale):
+    """
+    Decodes an image XObject for re-encoding. Plain DCT streams are opened directly
+    so downscaled trials can use the reduced-resolution JPEG decode; everything else
+    goes through pypdf.
+    """
+    if (scale < 1.0 and _pdf_filters(source) == ["/DCTDecode"]
+            and not any(key in source for key in ("/Decode", "/SMask", "/Mask"))):
+        img = Image.open(io.BytesIO(source._data))
+        if img.format == "JPEG" and img.mode in ("L", "RGB"):
+            _draft(img, _scaled_size(source["/Width"], source["/Height"], scale))
+            return img
+    return _xobj_to_image(source)[2]
+
+# Integer modes with 16 or 32 bits per sample, and float samples
+_WIDE_MODES = ("I", "I;16", "I;16L", "I;16B", "I;16N", "F")
+
+def _eight_bit(img):
+    """
+    Scales 16-bit grayscale samples to an 8-bit L image. Converting them directly
+    clips every value above 255 to white.
+    """
+    if img.mode.startswith("I;16"):
+        img = img.convert("I")
+    if img.mode == "I":
+        img = img.point(lambda v: v / 257)
+    return img.convert("L")
+
+def _jpeg_mode(img):
+    if img.mode in _WIDE_MODES:
+        return _eight_bit(img)
+    if img.mode not in ("L", "RGB"):
+        img = img.convert("L" if img.mode == "1" else "RGB")
+    return img
+
+def _encode_pdf_image(source, quality, scale, resample=DEFAULT_RESAMPLE, pixels=None, key=None):
+    """
+    Re-encodes an image XObject as JPEG at (quality, scale). With a `pixels`
+    cache (PixelCache) the decoded image and its levels are shared under `key`.
+    Returns (jpeg bytes, width, height, colorspace) or None.
+    """
+    try:
+        pil_img = None
+        if pixels is not None:
+            pil_img = pixels.level(key, (int(source["/Width"]), int(source["/Height"])), scale, resample,
+                                   lambda: _jpeg_mode(_xobj_to_image(source)[2]))
+        if pil_img is None:
+            pil_img = _jpeg_mode(_open_pdf_image(source, scale))
             if scale < 1.0:
-                new_size = (max(1, int(img.width * scale)), max(1, int(img.height * scale)))
-                img = img.resize(new_size, Image.Resampling.LANCZOS)
-            img.save(image_path, quality=quality, optimize=True)
-    except:
-        pass
+                pil_img = _downscale(pil_img, _scaled_size(source["/Width"], source["/Height"], scale), resample)
+        out = io.BytesIO()
+        pil_img.save(out, "JPEG", quality=quality, optimize=True)
+        colorspace = "/DeviceGray" if pil_img.mode == "L" else "/DeviceRGB"
+        return out.getvalue(), pil_img.width, pil_img.height, colorspace
+    except Exception:
+        return None
+
+# --- Process-pool PDF engine ---
+# Each worker parses the input once and keeps it for every trial of the search.
+_worker_reader = None
+_worker_pixels = None
+
+def _pdf_worker_init(input_path, pixel_budget=0):
+    global _worker_reader, _worker_pixels
+    logging.getLogger("pypdf").setLevel(logging.ERROR)
+    # An open file keeps the document on disk; a path would be read into memory whole
+    _worker_reader = PdfReader(open(input_path, "rb"), strict=False)
+    # Shards are not pinned to workers: each one caches what it decodes, within its share of the budget
+    _worker_pixels = PixelCache(pixel_budget) if pixel_budget else None
+
+def _pdf_worker_encode(refs, quality, scale, spool_path, resample=DEFAULT_RESAMPLE):
+    """
+    Encodes one shard of images and appends the JPEG bytes to spool_path.
+    Only (idnum, offset, length, width, height, colorspace) records travel back
+    through the pipe; the encoded data stays in the spool file.
+    """
+    records = []
+    with open(spool_path, "wb") as spool:
+        for idnum, generation in refs:
+            source = _worker_reader.get_object(IndirectObject(idnum, generation, _worker_reader))
+            encoded = _encode_pdf_image(source, quality, scale, resample, _worker_pixels, idnum)
+            if encoded is None:
+                records.append((idnum, None))
+                continue
+            data, width, height, colorspace = encoded
+            records.append((idnum, (spool.tell(), len(data), width, height, colorspace)))
+            spool.write(data)
+    return records
+
+def _shard_images(images, shards):
+    """
+    Splits images, ordered by the first page that shows them, into at most `shards`
+    contiguous page ranges of roughly equal stream bytes.
+    """
+    ordered = sorted(images, key=lambda image: min(image.pages))
+    budget = sum(len(image.source._data) for image in ordered) / max(1, shards)
+    result, current, current_bytes = [], [], 0
+    for image in ordered:
+        current.append(image)
+        current_bytes += len(image.source._data)
+        if current_bytes >= budget and len(result) < shards - 1:
+            result.append(current)
+            current, current_bytes = [], 0
+    if current:
+        result.append(current)
+    return result
+
+class PdfImage:
+    """
+    One unique image XObject of a PDF and the pages that display it.
+
+    `source` is the pristine object in the reader and `target` its clone in the writer.
+    """
+    def __init__(self, ref, source, digest):
+        self.ref = ref
+        self.source = source
+        self.digest = digest
+        self.pages = set()
+        self.target = None
+        self.original = None
+
+    def attach(self, target):
+        self.target = target
+        self.original = (target._data, {NameObject(key): target[key] for key in _PDF_IMAGE_KEYS if key in target})
+
+    def encode(self, quality, scale, resample=DEFAULT_RESAMPLE, pixels=None):
+        """
+        Decodes the original image, or takes it from `pixels` (PixelCache), and
+        re-encodes it as JPEG.
+        Returns (jpeg bytes, width, height, colorspace) or None if it cannot be converted.
+        """
+        return _encode_pdf_image(self.source, quality, scale, resample, pixels, self.digest)
 
-def parallel_compress_images(media_path, quality, scale, max_workers=4):
+    def replace(self, encoded):
+        """
+        Points the writer object at a new JPEG stream, or restores the original when
+        `encoded` is None or not smaller than what is already there.
+        """
+        data, keys = self.original
+        target = self.target
+        for key in _PDF_IMAGE_KEYS:
+            target.pop(key, None)
+        if encoded is None or len(encoded[0]) >= len(data):
+            target._data = data
+            target.update(keys)
+        else:
+            jpeg, width, height, colorspace = encoded
+            target._data = jpeg
+            target[NameObject("/Filter")] = NameObject("/DCTDecode")
+            target[NameObject("/Width")] = NumberObject(width)
+            target[NameObject("/Height")] = NumberObject(height)
+            target[NameObject("/ColorSpace")] = NameObject(colorspace)
+            target[NameObject("/BitsPerComponent")] = NumberObject(8)
+        if hasattr(target, "decoded_self"):
+            target.decoded_self = None
+
+class PdfImageIndex:
+    """
+    Parse-once view of a PDF for repeated compression trials.
+
+    The input is parsed a single time. Image XObjects are indexed by object reference
+    and by content hash; references to byte-identical copies are rewritten to one
+    canonical object before the document is cloned into the writer, so each unique
+    image is encoded once per trial no matter how many pages display it. Decoded
+    images are kept in a PixelCache of `pixel_budget` bytes (0 disables it), split
+    between the worker processes when there are any. `cancel` (CancelToken) is
+    checked per page while indexing and cloning.
+
+    Trials are encoded on the shared thread pool. With `processes` > 1 and at least
+    PDF_PROCESS_MIN_IMAGES unique images, a process pool is used instead; its
+    workers spool encoded images to temp files, which close() removes.
+    """
+    def __init__(self, input_path, processes=None, resample=DEFAULT_RESAMPLE, pixel_budget=PIXEL_CACHE_BYTES,
+                 cancel=None):
+        self.input_path = input_path
+        self.resample = resample
+        self.reader = PdfReader(input_path, strict=False)
+        self.images = []
+        by_ref, by_digest = {}, {}
+        for page_number, page in enumerate(self.reader.pages):
+            _check_cancel(cancel)
+            for xobjects, name, ref, obj in _iter_image_xobjects(page.get("/Resources"), set()):
+                key = ref.idnum if isinstance(ref, IndirectObject) else id(obj)
+                image = by_ref.get(key)
+                if image is None and isinstance(ref, IndirectObject) and _is_replaceable_image(obj):
+                    digest = _pdf_image_digest(obj)
+                    image = by_digest.get(digest)
+                    if image is None:
+                        image = by_digest[digest] = PdfImage(ref, obj, digest)
+                        self.images.append(image)
+                    else:
+                        xobjects[NameObject(name)] = image.ref
+                    by_ref[key] = image
+                if image is not None:
+                    image.pages.add(page_number)
+
+        # Duplicates are no longer referenced, so cloning leaves them behind
+        self.writer = PdfWriter(clone_from=self.reader)
+        by_ref = {image.ref.idnum: image for image in self.images}
+        for src_page, dst_page in zip(self.reader.pages, self.writer.pages):
+            _check_cancel(cancel)
+            pairs = zip(_iter_image_xobjects(src_page.get("/Resources"), set()),
+                        _iter_image_xobjects(dst_page.get("/Resources"), set()))
+            for (_, _, ref, _), (_, _, _, target) in pairs:
+                image = by_ref.get(ref.idnum) if isinstance(ref, IndirectObject) else None
+                if image is not None and image.target is None:
+                    image.attach(target)
+            dst_page.compress_content_streams()
+        self.images = [image for image in self.images if image.target is not None]
+
+        # Multi-process engine, on request only: page-range shards encoded by `processes`
+        # workers. Decode, resize and encode run in C with the GIL released (about 99% of
+        # the time per image), so threads on the shared executor already fill the cores.
+        if processes is None or len(self.images) < PDF_PROCESS_MIN_IMAGES:
+            processes = 1
+        self._pool = None
+        self._spool_dir = None
+        self.pixels = PixelCache(pixel_budget) if pixel_budget else None
+        if processes > 1 and len(self.images) > 1:
+            self._shards = _shard_images(self.images, processes * 2)
+            self._spool_dir = tempfile.mkdtemp(prefix="office_tools_pdf_")
+            workers = min(processes, len(self._shards))
+            self._pool = ProcessPoolExecutor(max_workers=workers, initializer=_pdf_worker_init,
+                                             initargs=(input_path, pixel_budget // workers))
+            self.pixels = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """
+        Stops the worker processes and removes their spool files.
+        """
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+        if self._spool_dir is not None:
+            shutil.rmtree(self._spool_dir, ignore_errors=True)
+            self._spool_dir = None
+
+    def apply(self, quality, scale=1.0, max_workers=None, on_image=None, cancel=None):
+        """
+        Re-encodes every unique image once at (quality, scale) and updates the writer.
+        `on_image(done, total)` is called per encoded image; `cancel` (CancelToken)
+        is checked before each image. Threaded encodes use parallel_map.
+        """
+        if self._pool is not None:
+            self._apply_sharded(quality, scale, on_image, cancel)
+            return
+        tick = _image_counter(on_image, len(self.images))
+
+        def encode(image):
+            _check_cancel(cancel)
+            result = image.encode(quality, scale, self.resample, self.pixels)
+            tick()
+            return result
+
+        for image, result in zip(self.images, parallel_map(encode, self.images, max_workers)):
+            image.replace(result)
+
+    def _apply_sharded(self, quality, scale, on_image=None, cancel=None):
+        futures = []
+        for n, shard in enumerate(self._shards):
+            refs = [(image.ref.idnum, image.ref.generation) for image in shard]
+            spool_path = os.path.join(self._spool_dir, f"shard-{n}.bin")
+            futures.append((shard, spool_path,
+                            self._pool.submit(_pdf_worker_encode, refs, quality, scale, spool_path,
+                                              self.resample)))
+
+        # Single merge step: read each shard's spool file and patch the writer objects
+        done = 0
+        for shard, spool_path, future in futures:
+            if cancel is not None and cancel.cancelled:
+                for _, _, pending in futures:
+                    pending.cancel()
+                cancel.raise_if_cancelled()
+            records = dict(future.result())
+            done += len(shard)
+            if on_image is not None:
+                on_image(done, len(self.images))
+            with open(spool_path, "rb") as spool:
+                spooled = spool.read()
+            for image in shard:
+                record = records.get(image.ref.idnum)
+                if record is None:
+                    image.replace(None)
+                    continue
+                offset, length, width, height, colorspace = record
+                image.replace((spooled[offset:offset + length], width, height, colorspace))
+
+    def write(self, stream):
+        """
+        Writes the current state of the document to a path or binary stream.
+        """
+        self.writer.write(stream)
+
+    def render(self, quality, scale=1.0):
+        """
+        Returns the document bytes for one trial.
+        """
+        self.apply(quality, scale)
+        out = io.BytesIO()
+        self.write(out)
+        return out.getvalue()
+
+# --- Streaming PDF engine ---
+# Default ceiling for decoded bitmaps held at once by the streaming engine
+PDF_STREAM_MEMORY = 256 * 1024 * 1024
+_PDF_SKIPPED_TYPES = ("/ObjStm", "/XRef")
+
+def _decoded_size(obj):
+    """
+    Upper bound of the memory a decoded image takes, including its downscaled copy.
+    """
+    return int(obj.get("/Width", 0)) * int(obj.get("/Height", 0)) * 4 * 2
+
+def _pdf_generations(reader):
+    """
+    {object number: generation} of every object in the cross-reference tables,
+    including objects stored in object streams.
+    """
+    generations = {}
+    for generation, table in reader.xref.items():
+        for idnum in table:
+            if generation < 65535 and idnum > 0:
+                generations[idnum] = max(generation, generations.get(idnum, 0))
+    for idnum in reader.xref_objStm:
+        generations.setdefault(idnum, 0)
+    return generations
+
+def stream_compress_pdf(input_path, output, quality, scale=1.0, memory_limit=PDF_STREAM_MEMORY,
+                        max_workers=None, on_object=None, cancel=None, resample=DEFAULT_RESAMPLE):
+    """
+    Rewrites a PDF object by object with its images re-encoded at (quality, scale),
+    or left as they are when quality is None, for documents too large to hold in memory. `output` is a path or binary stream.
+
+    The input is read from disk on demand, never loaded whole. Objects are taken in
+    chunks whose decoded images fit in `memory_limit` bytes (at least one image per
+    chunk); a chunk's images are encoded in parallel, the chunk is written out and
+    every object and bitmap of it is released before the next one is read. Peak
+    memory therefore follows the largest image, not the document size. Object
+    streams are expanded into plain objects, uncompressed streams are deflated,
+    and identical images are not merged as they are in PdfImageIndex.
+
+    `on_object(done, total)` is called after each chunk, counting objects; `cancel`
+    is checked between images. Returns the number of bytes written.
+    """
+    with open(input_path, "rb") as f:
+        reader = PdfReader(f, strict=False)
+        if reader.is_encrypted:
+            raise ValueError("Streaming mode does not support encrypted PDFs")
+        generations = _pdf_generations(reader)
+        total = len(generations)
+
+        out = open(output, "wb") if isinstance(output, (str, os.PathLike)) else output
+        try:
+            start = out.tell()
+            out.write(reader.pdf_header.encode("ascii") + b"\n%\xe2\xe3\xcf\xd3\n")
+            offsets = {}
+            pending, pending_bytes, done = [], 0, 0
+
+            def flush():
+                nonlocal pending, pending_bytes, done
+                images = [(i, obj) for i, (_, _, obj, is_image) in enumerate(pending) if is_image]
+
+                def encode(item):
+                    _check_cancel(cancel)
+                    return item[0], _encode_pdf_image(item[1], quality, scale, resample)
+
+                encoded = dict(parallel_map(encode, images, max_workers))
+                for i, (idnum, generation, obj, is_image) in enumerate(pending):
+                    result = encoded.get(i)
+                    if result is not None and len(result[0]) < len(obj._data):
+                        obj = _jpeg_stream(obj, result)
+                    elif (not is_image and isinstance(obj, StreamObject) and "/Filter" not in obj
+                          and obj.get("/Type") != "/Metadata"):
+                        obj = obj.flate_encode()
+                    offsets[idnum] = (out.tell() - start, generation)
+                    out.write(b"%d %d obj\n" % (idnum, generation))
+                    obj.write_to_stream(out)
+                    out.write(b"\nendobj\n")
+                done += len(pending)
+                pending, pending_bytes = [], 0
+                # Drop everything the reader parsed for this chunk, decoded data included
+                reader.resolved_objects.clear()
+                if on_object is not None:
+                    on_object(done, total)
+
+            for idnum in sorted(generations):
+                _check_cancel(cancel)
+                generation = generations[idnum]
+                try:
+                    obj = reader.get_object(IndirectObject(idnum, generation, reader))
+                except Exception:
+                    obj = None
+                if obj is None or (isinstance(obj, StreamObject) and obj.get("/Type") in _PDF_SKIPPED_TYPES):
+                    done += 1
+                    continue
+                is_image = (quality is not None and isinstance(obj, StreamObject)
+                            and obj.get("/Subtype") == "/Image" and _is_replaceable_image(obj))
+                cost = _decoded_size(obj) if is_image else len(getattr(obj, "_data", b""))
+                if pending and pending_bytes + cost > memory_limit:
+                    flush()
+                pending.append((idnum, generation, obj, is_image))
+                pending_bytes += cost
+            flush()
+
+            # Classic cross-reference table; numbers without an object are free entries
+            size = max(offsets, default=0) + 1
+            xref_offset = out.tell() - start
+            out.write(b"xref\n0 %d\n0000000000 65535 f \n" % size)
+            for idnum in range(1, size):
+                offset, generation = offsets.get(idnum, (0, 65535))
+                out.write(b"%010d %05d %s \n" % (offset, generation, b"n" if idnum in offsets else b"f"))
+            trailer = DictionaryObject({NameObject("/Size"): NumberObject(size)})
+            for key in ("/Root", "/Info", "/ID"):
+                if key in reader.trailer:
+                    trailer[NameObject(key)] = reader.trailer.raw_get(key)
+            out.write(b"trailer\n")
+            trailer.write_to_stream(out)
+            out.write(b"\nstartxref\n%d\n%%%%EOF\n" % xref_offset)
+            return out.tell() - start
+        finally:
+            if out is not output:
+                out.close()
+
+def _jpeg_stream(source, encoded):
     """
-    Compresses images in a directory in parallel.
+    A copy of image XObject `source` holding the JPEG from _encode_pdf_image.
+    """
+    jpeg, width, height, colorspace = encoded
+    obj = StreamObject()
+    obj.update({key: value for key, value in source.items() if key not in _PDF_IMAGE_KEYS})
+    obj[NameObject("/Filter")] = NameObject("/DCTDecode")
+    obj[NameObject("/Width")] = NumberObject(width)
+    obj[NameObject("/Height")] = NumberObject(height)
+    obj[NameObject("/ColorSpace")] = NameObject(colorspace)
+    obj[NameObject("/BitsPerComponent")] = NumberObject(8)
+    obj._data = jpeg
+    return obj
+
+def compress_pdf(input_path, output_path, quality=None, scale=1.0, processes=None,
+                 progress=None, cancel=None, resample=DEFAULT_RESAMPLE, memory_limit=None):
+    """
+    Compresses a PDF file by reducing image quality and content stream compression.
+    `processes` sets the size of the optional process pool (None or 1 encodes on
+    the shared thread pool; see PdfImageIndex). `progress` receives the same events as
+    compress_file; `cancel` is a CancelToken. `resample` names one of
+    RESAMPLE_FILTERS for downscaling. With `memory_limit` (bytes), the document is
+    streamed through stream_compress_pdf instead of being held in memory.
+    """
+    timer = PhaseTimer(progress)
+    if memory_limit is not None:
+        on_object = lambda done, total: _emit(progress, "image_encoded", trial=1, done=done, total=total)
+        with timer.phase("encode"):
+            stream_compress_pdf(input_path, output_path, quality, scale, memory_limit,
+                                on_object=on_object, cancel=cancel, resample=resample)
+        return
+    with timer.phase("load"):
+        index = PdfImageIndex(input_path, processes=processes, resample=resample)
+    with index:
+        if quality:
+            on_image = lambda done, total: _emit(progress, "image_encoded", trial=1, done=done, total=total)
+            with timer.phase("encode"):
+                index.apply(quality, scale, on_image=on_image, cancel=cancel)
+        with timer.phase("write"):
+            index.write(output_path)
+
+# Share of distinct colors in a sampled image above which it is treated as a photo
+PHOTO_COLOR_RATIO = 0.25
+# Below this quality, PNGs with more than 256 colors are quantized to a palette
+PNG_PALETTE_QUALITY = 90
+# Quality used for a part that changes format when its original is asked for
+TRANSCODE_QUALITY = 95
+# zlib strategies tried for every PNG; the smallest result wins
+_PNG_STRATEGIES = (zlib.Z_DEFAULT_STRATEGY, zlib.Z_FILTERED, zlib.Z_RLE)
+_FORMAT_EXTENSIONS = {"JPEG": ('.jpeg', '.jpg'), "PNG": ('.png',)}
+_FORMAT_CONTENT_TYPES = {"JPEG": "image/jpeg", "PNG": "image/png"}
+
+def _has_transparency(img):
+    """
+    True if any pixel of img is not fully opaque. Only the extrema of the alpha
+    band are computed, in a single C pass.
+    """
+    if "transparency" in img.info:
+        img = img.convert("RGBA")
+    if "A" not in img.getbands():
+        return False
+    return img.getchannel("A").getextrema()[0] < 255
+
+def _is_photo_like(img, sample=128):
+    """
+    True when a nearest-neighbour sample of img is mostly distinct colors, as in
+    photos. Screenshots and diagrams reuse a small set of flat colors.
+    """
+    ratio = min(1.0, sample / max(img.width, img.height))
+    size = (max(1, int(img.width * ratio)), max(1, int(img.height * ratio)))
+    thumb = img.resize(size, Image.Resampling.NEAREST).convert("RGB")
+    pixels = size[0] * size[1]
+    return len(thumb.getcolors(pixels)) > PHOTO_COLOR_RATIO * pixels
+
+def media_format(data):
+    """
+    Output format ("JPEG" or "PNG") for a raster media part, or None to keep its bytes.
+    JPEGs stay JPEG; opaque photo-like images in any other format become JPEG, and
+    everything else (screenshots, diagrams, transparent images) becomes PNG.
+    Animated and multi-page images, images with more than 8 bits per sample and
+    images that cannot be decoded are kept.
+    """
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            if img.format in ("JPEG", "MPO"):
+                return "JPEG"
+            if getattr(img, "n_frames", 1) > 1 or img.mode in _WIDE_MODES:
+                return None
+            if not _has_transparency(img) and _is_photo_like(img):
+                return "JPEG"
+            return "PNG"
+    except Exception:
+        return None
+
+def _encode_png(img, quality, out):
+    """
+    Writes img as the smallest PNG among _PNG_STRATEGIES. Images with at most 256
+    colors become exact palette images; below PNG_PALETTE_QUALITY the others are
+    quantized to a palette that shrinks with quality. Pillow filters palette rows
+    with filter None and truecolor rows adaptively, so choosing the palette also
+    chooses the row filter.
+    """
+    if img.mode == "RGBA" and not _has_transparency(img):
+        img = img.convert("RGB")
+    if img.mode == "RGB" and img.getcolors(256) is not None:
+        img = img.quantize(256, method=Image.Quantize.MEDIANCUT, dither=Image.Dither.NONE)
+    elif img.mode in ("RGB", "RGBA") and quality < PNG_PALETTE_QUALITY:
+        colors = max(16, 256 * quality // PNG_PALETTE_QUALITY)
+        method = Image.Quantize.FASTOCTREE if img.mode == "RGBA" else Image.Quantize.MEDIANCUT
+        img = img.quantize(colors, method=method, dither=Image.Dither.NONE)
+    best = None
+    for strategy in _PNG_STRATEGIES:
+        trial = io.BytesIO()
+        img.save(trial, format="PNG", compress_level=9, compress_type=strategy)
+        if best is None or trial.tell() < len(best):
+            best = trial.getvalue()
+    out.write(best)
+
+def _decode(data):
+    img = Image.open(io.BytesIO(data))
+    img.load()
+    return img
+
+def _encodable(img, fmt):
+    if img.mode in _WIDE_MODES:
+        return _eight_bit(img)
+    if fmt in ("JPEG", "PNG") and img.mode not in ("L", "RGB", "RGBA", "CMYK"):
+        return img.convert("RGBA" if _has_transparency(img) else "RGB")
+    return img
+
+def encode_image(data, quality=70, scale=1.0, fmt=None, resample=DEFAULT_RESAMPLE, pixels=None, key=None):
+    """
+    Re-encodes image bytes with optional scaling, as `fmt` ("JPEG" or "PNG", see
+    media_format) or in their original format when fmt is None. Downscaled JPEGs
+    are decoded at reduced resolution; `resample` names one of RESAMPLE_FILTERS.
+    With a `pixels` cache (PixelCache) the decoded image and its levels are
+    shared under `key` instead.
+    Returns the original bytes if the image cannot be decoded or re-encoded.
+    """
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            fmt = fmt or img.format
+            level = None
+            if pixels is not None:
+                # Decoded apart from `img`, which is closed on return
+                level = pixels.level(key, img.size, scale, resample, lambda: _encodable(_decode(data), fmt))
+            if level is None:
+                size = _scaled_size(img.width, img.height, scale)
+                if scale < 1.0:
+                    _draft(img, size)
+                level = _encodable(img, fmt)
+                if scale < 1.0:
+                    level = _downscale(level, size, resample)
+            out = io.BytesIO()
+            if fmt == "PNG":
+                _encode_png(level, quality, out)
+            else:
+                if fmt == "JPEG" and level.mode == "RGBA":
+                    level = level.convert("RGB")  # only opaque images are sent to JPEG
+                level.save(out, format=fmt, quality=quality, optimize=True)
+            return out.getvalue()
+    except Exception:
+        return data
+
+def compress_image(image_path, quality=70, scale=1.0, resample=DEFAULT_RESAMPLE):
+    """
+    Compresses a single image file with optional scaling.
+    """
+    with open(image_path, "rb") as f:
+        data = f.read()
+    encoded = encode_image(data, quality, scale, resample=resample)
+    if encoded is not data:
+        with open(image_path, "wb") as f:
+            f.write(encoded)
+
+def parallel_compress_images(media_path, quality, scale, max_workers=None, resample=DEFAULT_RESAMPLE):
+    """
+    Compresses images in a directory in parallel. Files with identical content
+    are encoded once and the result is copied to the others.
     """
     if not os.path.exists(media_path):
         return
     
     files = [os.path.join(media_path, f) for f in os.listdir(media_path) 
-             if f.lower().endswith(('.png', '.jpg', '.jpeg'))]
-    
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        executor.map(lambda f: compress_image(f, quality, scale), files)
+             if f.lower().endswith(MEDIA_EXTENSIONS)]
+    copies = {}
+    for path in files:
+        copies.setdefault(file_digest(path), []).append(path)
+
+    def compress(paths):
+        compress_image(paths[0], quality, scale, resample)
+        for path in paths[1:]:
+            shutil.copyfile(paths[0], path)
+
+    parallel_map(compress, copies.values(), max_workers)
+
+# ZIP record layouts (PKWARE APPNOTE 4.3.7, 4.3.12 and 4.3.16)
+_LOCAL_HEADER = struct.Struct("<4s5H3L2H")
+_CENTRAL_HEADER = struct.Struct("<4s6H3L5H2L")
+_END_OF_CENTRAL_DIR = struct.Struct("<4s4H2LH")
+_FLAG_DATA_DESCRIPTOR = 0x08
+_ZIP32_LIMIT = 0xFFFFFFFF
+
+def _dos_datetime(date_time):
+    year, month, day, hour, minute, second = date_time
+    dos_date = (max(year, 1980) - 1980) << 9 | month << 5 | day
+    dos_time = hour << 11 | minute << 5 | second // 2
+    return dos_time, dos_date
+
+def is_media_part(name):
+    """
+    True for image parts stored under a package 'media' folder (word/media, xl/media, ...).
+    """
+    folder, filename = posixpath.split(name)
+    return posixpath.basename(folder) == 'media' and filename.lower().endswith(MEDIA_EXTENSIONS)
+
+# Deflate level per entry class (see entry_class); None stores the entry uncompressed.
+# Non-media parts are only re-packed when stored uncompressed (or when their class is
+# in OfficePackage's `recompress`); parts already deflated keep their original bytes.
+ZIP_LEVELS = {"image": None, "media": 9, "xml": 9}
+_COMPRESSED_IMAGE_EXTENSIONS = ('.jpeg', '.jpg', '.png', '.gif')
+
+def entry_class(name):
+    """
+    Class of a package entry for ZIP_LEVELS: 'image' for already compressed images
+    (JPEG, PNG, GIF) in a media folder, 'media' for other media parts (EMF, WMF,
+    BMP, TIFF), 'xml' for XML and relationship parts, 'other' for the rest.
+    """
+    folder, filename = posixpath.split(name)
+    extension = posixpath.splitext(filename)[1].lower()
+    if posixpath.basename(folder) == 'media':
+        return "image" if extension in _COMPRESSED_IMAGE_EXTENSIONS else "media"
+    if extension in ('.xml', '.rels', '.vml'):
+        return "xml"
+    return "other"
+
+CONTENT_TYPES_PART = "[Content_Types].xml"
+_RELATIONSHIP_TAG = re.compile(rb'<Relationship\b[^>]*>')
+_TARGET_ATTR = re.compile(rb'\bTarget="([^"]*)"')
+_OVERRIDE_TAG = re.compile(rb'<Override\b[^>]*>')
+_PART_NAME_ATTR = re.compile(rb'\bPartName="([^"]*)"')
+_CONTENT_TYPE_ATTR = re.compile(rb'\bContentType="([^"]*)"')
+
+def rewrite_relationships(xml, rels_name, mapping):
+    """
+    Points the relationships of a .rels part at new part names. `mapping` is
+    {old part name: new part name}. Targets are resolved against the folder of the
+    part that owns the .rels file and rewritten in the same relative or absolute
+    form; external targets are left alone. Returns the new XML, or None if no
+    target changed.
+    """
+    base = posixpath.dirname(posixpath.dirname(rels_name))
+    changed = False
+
+    def retarget(match):
+        nonlocal changed
+        tag = match.group(0)
+        target = _TARGET_ATTR.search(tag)
+        if target is None or b'TargetMode="External"' in tag:
+            return tag
+        value = target.group(1).decode("utf-8")
+        if value.startswith("/"):
+            new_name = mapping.get(value[1:])
+            new_value = new_name and "/" + new_name
+        else:
+            new_name = mapping.get(posixpath.normpath(posixpath.join(base, value)))
+            new_value = new_name and posixpath.relpath(new_name, base or ".")
+        if new_value is None:
+            return tag
+        changed = True
+        return tag[:target.start(1)] + new_value.encode("utf-8") + tag[target.end(1):]
+
+    xml = _RELATIONSHIP_TAG.sub(retarget, xml)
+    return xml if changed else None
+
+def rewrite_content_types(xml, renames, formats, removed=()):
+    """
+    Updates [Content_Types].xml for renamed and removed parts: Override entries
+    follow their part to its new name and format or are dropped with it, and a
+    Default is added for every new extension. `formats` maps each new part name
+    to its format ("JPEG" or "PNG").
+    """
+    def move(match):
+        tag = match.group(0)
+        part_name = _PART_NAME_ATTR.search(tag)
+        name = part_name and part_name.group(1).decode("utf-8").lstrip("/")
+        if name in removed:
+            return b""
+        new_name = name and renames.get(name)
+        if new_name is None:
+            return tag
+        tag = tag[:part_name.start(1)] + b"/" + new_name.encode("utf-8") + tag[part_name.end(1):]
+        return _CONTENT_TYPE_ATTR.sub(
+            b'ContentType="' + _FORMAT_CONTENT_TYPES[formats[new_name]].encode() + b'"', tag, count=1)
+
+    xml = _OVERRIDE_TAG.sub(move, xml)
+    defaults = {}
+    for new_name in renames.values():
+        extension = posixpath.splitext(new_name)[1][1:]
+        defaults.setdefault(extension.lower(), (extension, _FORMAT_CONTENT_TYPES[formats[new_name]]))
+    for key, (extension, content_type) in sorted(defaults.items()):
+        if re.search(rb'<Default\b[^>]*\bExtension="' + re.escape(key.encode()) + b'"', xml, re.IGNORECASE):
+            continue
+        default = f'<Default Extension="{extension}" ContentType="{content_type}"/>'.encode()
+        xml = xml.replace(b"</Types>", default + b"</Types>", 1)
+    return xml
+
+class PackedData:
+    """
+    Payload of a ZIP entry as written to disk: compressed bytes plus CRC and uncompressed size.
+    """
+    __slots__ = ("raw", "crc", "size", "method")
+
+    def __init__(self, raw, crc, size, method):
+        self.raw = raw
+        self.crc = crc
+        self.size = size
+        self.method = method
+
+    @classmethod
+    def deflate(cls, data, level=zlib.Z_DEFAULT_COMPRESSION):
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        raw = compressor.compress(data) + compressor.flush()
+        return cls(raw, zlib.crc32(data), len(data), zipfile.ZIP_DEFLATED)
+
+    @classmethod
+    def pack(cls, data, level):
+        """
+        Deflates data at `level`, or stores it uncompressed when level is None.
+        """
+        if level is None:
+            return cls(data, zlib.crc32(data), len(data), zipfile.ZIP_STORED)
+        return cls.deflate(data, level)
+
+    def read(self):
+        """
+        Returns the uncompressed payload.
+        """
+        return zlib.decompress(self.raw, -15) if self.method == zipfile.ZIP_DEFLATED else self.raw
+
+class EncodedImageCache:
+    """
+    Thread-safe LRU memo of encoded images keyed by (content hash, quality, scale, resample filter).
+
+    Entries are PackedData, so a trial can be scored by summing entry sizes and the
+    winning trial can be written without encoding anything again. The total size of
+    the stored payloads is kept under max_bytes by evicting least recently used entries.
+    """
+    def __init__(self, max_bytes=ENCODE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            packed = self._entries.get(key)
+            if packed is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return packed
+
+    def put(self, key, packed):
+        size = len(packed.raw)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.current_bytes -= len(old.raw)
+            self._entries[key] = packed
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.current_bytes -= len(evicted.raw)
+
+class PackagePart:
+    """
+    One ZIP entry of an Office package, kept as its original compressed bytes.
+    """
+    def __init__(self, info, raw):
+        self.info = info
+        self.name = info.filename
+        self.raw = raw
+        # Name and format of the part in the output; a format of None keeps the original bytes
+        self.output_name = self.name
+        self.format = None
+        self._digest = None
+
+    @property
+    def digest(self):
+        """
+        SHA-256 of the uncompressed content, used to key encoded variants of the part.
+        """
+        if self._digest is None:
+            self._digest = hashlib.sha256(self.read()).hexdigest()
+        return self._digest
+
+    @property
+    def header_size(self):
+        """
+        Bytes taken by this entry's local and central directory headers.
+        """
+        name_len = len(self.output_name.encode("utf-8" if self.info.flag_bits & 0x800 else "cp437"))
+        return _LOCAL_HEADER.size + _CENTRAL_HEADER.size + 2 * name_len
+
+    @property
+    def is_media(self):
+        return is_media_part(self.name)
+
+    @property
+    def packed(self):
+        """
+        The part's original payload as PackedData.
+        """
+        return PackedData(self.raw, self.info.CRC, self.info.file_size, self.info.compress_type)
+
+    def read(self):
+        """
+        Returns the uncompressed content of the part.
+        """
+        if self.info.compress_type == zipfile.ZIP_STORED:
+            return self.raw
+        if self.info.compress_type == zipfile.ZIP_DEFLATED:
+            return zlib.decompress(self.raw, -15)
+        raise NotImplementedError(f"Unsupported compression method {self.info.compress_type} for {self.name}")
+
+class OfficePackage:
+    """
+    In-memory view of a docx/xlsx package.
+
+    The central directory is read once. Every part keeps its original compressed
+    bytes so it can be copied into a new archive without inflating or deflating it;
+    only media parts handed to write() as replacements are re-encoded.
+
+    With `dedup`, media parts with identical content are stored once: the first
+    copy is kept and relationships to the others are pointed at it.
+
+    With `transcode`, each raster media part is assigned an output format once (see
+    media_format). Parts that change format are renamed (image1.png -> image1.jpeg),
+    and the .rels and [Content_Types].xml parts that reference them are rewritten.
+
+    `levels` ({entry class: deflate level or None}, default ZIP_LEVELS) sets how
+    entries are packed: encoded media use the level of their class, and non-media
+    parts of a listed class that are stored uncompressed are deflated once, in
+    parallel threads (zlib releases the GIL), keeping the result only when it is
+    smaller. Parts that are already deflated are copied raw unless their class is
+    in `recompress`, since inflating and deflating a large sheet again costs
+    seconds for a few percent. Rewritten and re-packed parts are held in
+    `rewritten` and count as fixed overhead. `resample` names
+    the RESAMPLE_FILTERS entry used for downscaled media.
+
+    Media are decoded once into a PixelCache of `pixel_budget` bytes (0 disables
+    it) and every trial encodes from the cached levels.
+
+    `cancel` (CancelToken) is checked before each part is hashed, planned or
+    re-packed while loading.
+    """
+    def __init__(self, path, transcode=True, levels=None, max_workers=None, resample=DEFAULT_RESAMPLE,
+                 dedup=True, pixel_budget=PIXEL_CACHE_BYTES, recompress=(), cancel=None):
+        self.parts = []
+        with open(path, "rb") as f, zipfile.ZipFile(f) as zf:
+            for info in zf.infolist():
+                self.parts.append(PackagePart(info, self._read_raw(f, info)))
+        self.media = [part for part in self.parts if part.is_media]
+        self.levels = ZIP_LEVELS if levels is None else levels
+        self.recompress = recompress
+        self.resample = resample
+        self.pixels = PixelCache(pixel_budget) if pixel_budget else None
+        self.rewritten = {}
+        self.duplicates = self._dedup(cancel) if dedup else {}
+        renames = self._plan_media(cancel) if transcode else {}
+        contents = self._rewrite_references(renames)
+        self._repack(contents, max_workers, cancel)
+
+    def level_for(self, name):
+        """
+        Deflate level (None: stored) for an entry written under `name`.
+        """
+        return self.levels.get(entry_class(name), zlib.Z_DEFAULT_COMPRESSION)
+
+    def _dedup(self, cancel=None):
+        """
+        Keeps the first media part of each distinct content and drops the others
+        from the package. Returns {dropped part name: canonical part}.
+        """
+        canonical, duplicates = {}, {}
+        for part in self.media:
+            _check_cancel(cancel)
+            first = canonical.setdefault(part.digest, part)
+            if first is not part:
+                duplicates[part.name] = first
+        if duplicates:
+            self.parts = [part for part in self.parts if part.name not in duplicates]
+            self.media = [part for part in self.media if part.name not in duplicates]
+        return duplicates
+
+    def _plan_media(self, cancel=None):
+        """
+        Assigns output formats and names to media parts. Returns {old name: new name}
+        for the parts that change format.
+        """
+        formats = {}
+        names = {part.name.lower() for part in self.parts}
+        renames = {}
+        for part in self.media:
+            _check_cancel(cancel)
+            if part.digest not in formats:
+                formats[part.digest] = media_format(part.read())
+            part.format = formats[part.digest]
+            if part.format is None:
+                continue
+            stem, extension = posixpath.splitext(part.name)
+            if extension.lower() in _FORMAT_EXTENSIONS[part.format]:
+                continue
+            new_name = stem + _FORMAT_EXTENSIONS[part.format][0]
+            if new_name.lower() in names:
+                # The new name is taken: keep the original format (PNGs can still be re-encoded)
+                part.format = "PNG" if extension.lower() == ".png" else None
+                continue
+            names.add(new_name.lower())
+            part.output_name = renames[part.name] = new_name
+        return renames
+
+    def _rewrite_references(self, renames):
+        """
+        Points relationships at renamed parts and at the canonical copy of dropped
+        duplicates, and updates [Content_Types].xml to match. Returns the new
+        content of the parts that changed, by part name.
+        """
+        contents = {}
+        if not renames and not self.duplicates:
+            return contents
+        targets = dict(renames)
+        targets.update((name, first.output_name) for name, first in self.duplicates.items())
+        output_formats = {part.output_name: part.format for part in self.media}
+        for part in self.parts:
+            if part.name.endswith(".rels"):
+                xml = rewrite_relationships(part.read(), part.name, targets)
+            elif part.name == CONTENT_TYPES_PART:
+                xml = rewrite_content_types(part.read(), renames, output_formats, self.duplicates)
+            else:
+                continue
+            if xml is not None:
+                contents[part.name] = xml
+        return contents
+
+    def _repack(self, contents, max_workers, cancel=None):
+        """
+        Packs the changed parts in `contents` and re-packs the non-media parts whose
+        class has a level and that are stored, or whose class is in `recompress`,
+        into `rewritten`.
+        """
+        def pack(part):
+            _check_cancel(cancel)
+            data = contents.get(part.name)
+            packed = PackedData.pack(part.read() if data is None else data, self.level_for(part.name))
+            if data is not None or len(packed.raw) < len(part.raw):
+                self.rewritten[part.name] = packed
+
+        def wanted(part):
+            cls = entry_class(part.name)
+            return (not part.is_media and cls in self.levels
+                    and (part.info.compress_type == zipfile.ZIP_STORED or cls in self.recompress))
+
+        parts = [part for part in self.parts if part.name in contents or wanted(part)]
+        parallel_map(pack, parts, max_workers)
+
+    @staticmethod
+    def _read_raw(f, info):
+        f.seek(info.header_offset)
+        header = _LOCAL_HEADER.unpack(f.read(_LOCAL_HEADER.size))
+        if header[0] != zipfile.stringFileHeader:
+            raise zipfile.BadZipFile(f"Bad local file header for {info.filename}")
+        name_len, extra_len = header[9], header[10]
+        f.seek(name_len + extra_len, os.SEEK_CUR)
+        return f.read(info.compress_size)
+
+    def fixed_overhead(self):
+        """
+        Size in bytes of everything in the output archive except the media payloads.
+        """
+        overhead = _END_OF_CENTRAL_DIR.size
+        for part in self.parts:
+            overhead += part.header_size
+            if not part.is_media:
+                packed = self.rewritten.get(part.name)
+                overhead += len(packed.raw if packed is not None else part.raw)
+        return overhead
+
+    def encode_media(self, quality, scale, cache=None, max_workers=None, on_image=None, cancel=None,
+                     per_image=None):
+        """
+        Encodes all media parts in memory. Returns {part name: PackedData}.
+        Encodings found in `cache` are reused; new ones are added to it.
+        `on_image(done, total)` is called per image; `cancel` is checked before each one.
+        `per_image` ({digest: (quality, scale)}) overrides the settings for some images;
+        a quality of None keeps the original part untouched, or for a part that
+        changes format, encodes it at TRANSCODE_QUALITY and full scale. Parts
+        without an output format (see media_format) are always kept untouched.
+        """
+        tick = _image_counter(on_image, len(self.media))
+
+        def encode(part):
+            _check_cancel(cancel)
+            q, s = per_image.get(part.digest, (quality, scale)) if per_image else (quality, scale)
+            renamed = part.output_name != part.name
+            if q is None and renamed:
+                q, s = TRANSCODE_QUALITY, 1.0
+            if q is None or part.format is None:
+                tick()
+                return part.packed
+            key = (part.digest, q, s, self.resample)
+            packed = cache.get(key) if cache is not None else None
+            if packed is None:
+                packed = PackedData.pack(encode_image(part.read(), q, s, part.format, self.resample,
+                                                      self.pixels, part.digest),
+                                         self.level_for(part.output_name))
+                if cache is not None:
+                    cache.put(key, packed)
+            tick()
+            # A part that keeps its name and format never grows
+            if not renamed and len(packed.raw) >= len(part.raw):
+                return part.packed
+            return packed
+
+        return dict(zip((part.name for part in self.media), parallel_map(encode, self.media, max_workers)))
+
+    def trial_size(self, quality, scale, cache=None):
+        """
+        Exact size in bytes the package would have at (quality, scale), without writing it.
+        """
+        encoded = self.encode_media(quality, scale, cache)
+        return self.fixed_overhead() + sum(len(packed.raw) for packed in encoded.values())
+
+    def write(self, output_path, replacements=None):
+        """
+        Writes the package to output_path with [Content_Types].xml first and the
+        other entries in their original order.
+        Parts in `replacements` ({name: PackedData}) or `rewritten` are written from
+        those payloads, under their output names; all others are copied raw.
+        Returns the number of bytes written.
+        """
+        replacements = {**self.rewritten, **(replacements or {})}
+        # OPC consumers expect [Content_Types].xml to be the first entry
+        parts = sorted(self.parts, key=lambda part: part.name != CONTENT_TYPES_PART)
+        central = []
+        with open(output_path, "wb") as out:
+            for part in parts:
+                info = part.info
+                flags = info.flag_bits & ~_FLAG_DATA_DESCRIPTOR
+                packed = replacements.get(part.name)
+                if packed is not None:
+                    raw, method, crc, size = packed.raw, packed.method, packed.crc, packed.size
+                else:
+                    raw, method = part.raw, info.compress_type
+                    crc, size = info.CRC, info.file_size
+                if max(size, len(raw), out.tell()) > _ZIP32_LIMIT:
+                    raise zipfile.LargeZipFile(f"{part.name} would require ZIP64 extensions")
+
+                name = part.output_name.encode("utf-8" if flags & 0x800 else "cp437")
+                dos_time, dos_date = _dos_datetime(info.date_time)
+                offset = out.tell()
+                out.write(_LOCAL_HEADER.pack(zipfile.stringFileHeader, 20, flags, method,
+                                             dos_time, dos_date, crc, len(raw), size, len(name), 0))
+                out.write(name)
+                out.write(raw)
+                central.append(_CENTRAL_HEADER.pack(zipfile.stringCentralDir, 20, 20, flags, method,
+                                                    dos_time, dos_date, crc, len(raw), size, len(name),
+                                                    0, 0, 0, info.internal_attr, info.external_attr,
+                                                    offset) + name)
+
+            cd_offset = out.tell()
+            for record in central:
+                out.write(record)
+            cd_size = out.tell() - cd_offset
+            out.write(_END_OF_CENTRAL_DIR.pack(zipfile.stringEndArchive, 0, 0, len(central),
+                                               len(central), cd_size, cd_offset, 0))
+            return out.tell()
 
 def get_file_size_mb(file_path):
     if not os.path.exists(file_path): return float('inf')
     return os.path.getsize(file_path) / (1024 * 1024)
 
-def iterative_compress(input_path, output_path, target_size_mb, file_type):
+COMPRESSIBLE_TYPES = ('pdf', 'docx', 'xlsx')
+
+class PhaseTimer:
+    """
+    Accumulates wall time per named phase (load, encode, write, size_check) and
+    reports each completed phase to an optional progress callback.
+    """
+    def __init__(self, progress=None):
+        self.durations = {}
+        self.progress = progress
+
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - started
+            self.durations[name] = self.durations.get(name, 0.0) + seconds
+            _emit(self.progress, "phase", phase=name, seconds=seconds)
+
+@dataclass
+class CompressionResult:
     """
-    High-precision search with Master-Temp caching for maximum speed and accuracy.
+    Outcome of one compression run, as reported by compress_file.
+    """
+    input_path: str
+    output_path: str
+    file_type: str
+    target_size_mb: float
+    original_size_mb: float
+    final_size_mb: float = 0.0
+    quality: int = None
+    scale: float = None
+    trials: int = 0
+    found_fit: bool = False
+    status: str = "pending"
+    elapsed: float = 0.0
+    cache_hit: bool = False
+    converged: bool = True
+    mode: str = "standard"
+    score: float = None
+    estimated_min_mb: float = None
+    phases: dict = field(default_factory=dict)
+
+    @property
+    def message(self):
+        if self.status == "already_under_target":
+            return "Already under target"
+        message = f"Target Met: {self.found_fit} (Q:{self.quality} S:{self.scale}, {self.trials} trials)"
+        if not self.found_fit and self.estimated_min_mb is not None:
+            message += f" [smallest reachable ~{self.estimated_min_mb * 1024:.0f} KB]"
+        return message if self.converged else message + " [time budget reached]"
+
+    def to_dict(self):
+        return asdict(self)
+
+# Search modes: "standard" bisects quality per scale for the highest quality that fits;
+# "perceptual" picks the uniform (quality, scale) with the best SSIM under the target;
+# "allocate" chooses settings per image to maximize mean SSIM under the target.
+SEARCH_MODES = ("standard", "perceptual", "allocate")
+# (scale, quality) grid scored by the perceptual modes
+PERCEPTUAL_GRID = [(scale, quality) for scale in (1.0, 0.75, 0.5, 0.3) for quality in (85, 65, 45, 25)]
+
+def _perceptual_office_search(package, cache, overhead, target_bytes, per_image, start_trial, end_trial,
+                              stop, timer):
+    """
+    Scores every image of `package` at each PERCEPTUAL_GRID point against its
+    original (SSIM on native-resolution luma tiles) and picks settings under
+    target_bytes.
+    Returns ({digest: (quality, scale)}, mean score, fits, converged).
+    """
+    import perceptual
+
+    # Originals are decoded once; only their luma tiles and tile statistics are kept
+    unique = {}
+    for part in package.media:
+        unique.setdefault(part.digest, []).append(part)
+    references = {}
+    with timer.phase("decode"):
+        try:
+            for digest, parts in unique.items():
+                _check_cancel(stop)
+                try:
+                    with Image.open(io.BytesIO(parts[0].read())) as img:
+                        boxes = perceptual.tile_boxes(img.width, img.height)
+                        tiles = perceptual.reference_tiles(perceptual.luma_tiles(img, boxes))
+                        references[digest] = (img.size, boxes, tiles)
+                except Exception:
+                    pass  # undecodable parts are always kept as they are
+        except _DeadlineReached:
+            pass  # the grid below stops at its first trial
+
+    # Every image can stay as it is, at full score and its original cost, unless it
+    # changes format; those only have their grid encodings to choose from
+    candidates = {digest: [(len(parts[0].raw) * len(parts), 1.0, (None, 1.0))]
+                  if parts[0].output_name == parts[0].name else []
+                  for digest, parts in unique.items()}
+    fixed = {digest: (None, 1.0) for digest in unique if digest not in references}
+    uniform = []
+    converged = True
+    try:
+        for scale, quality in PERCEPTUAL_GRID:
+            on_image = start_trial(quality, scale)
+            with timer.phase("encode"):
+                encoded = package.encode_media(quality, scale, cache, on_image=on_image, cancel=stop,
+                                               per_image=fixed)
+            with timer.phase("score"):
+                def score(digest):
+                    size, boxes, reference = references[digest]
+                    with Image.open(io.BytesIO(encoded[unique[digest][0].name].read())) as img:
+                        return perceptual.tile_ssim(reference, perceptual.luma_tiles(img, boxes, size))
+
+                scores = parallel_map(score, list(references))
+                for digest, image_score in zip(references, scores):
+                    packed = encoded[unique[digest][0].name]
+                    candidates[digest].append((len(packed.raw) * len(unique[digest]), image_score,
+                                               (quality, scale)))
+            with timer.phase("size_check"):
+                total = overhead + sum(len(packed.raw) for packed in encoded.values())
+            mean_score = sum(scores) / len(scores) if scores else 1.0
+            uniform.append((total, mean_score, quality, scale))
+            end_trial(quality, scale, total, total <= target_bytes, score=mean_score)
+    except _DeadlineReached:
+        converged = False
+
+    if per_image:
+        with timer.phase("allocate"):
+            chosen, fits = perceptual.allocate({digest: options for digest, options in candidates.items()
+                                                if options}, target_bytes - overhead)
+        settings = {digest: option[2] for digest, option in chosen.items()}
+        scores = [chosen[digest][1] for digest in references if digest in chosen]
+        return settings, (sum(scores) / len(scores) if scores else 1.0), fits, converged
+
+    fitting = [u for u in uniform if u[0] <= target_bytes]
+    if fitting:
+        total, score, quality, scale = max(fitting, key=lambda u: (u[1], -u[0]))
+    elif uniform:
+        total, score, quality, scale = min(uniform)
+    else:
+        return {}, 1.0, False, converged
+    settings = dict.fromkeys(unique, (quality, scale))
+    settings.update(fixed)
+    return settings, score, total <= target_bytes, converged
+
+def file_type_for(path):
+    """
+    Compression type ('pdf', 'docx' or 'xlsx') for a path, from its extension.
+    """
+    file_type = os.path.splitext(path)[1][1:].lower()
+    if file_type not in COMPRESSIBLE_TYPES:
+        raise ValueError(f"Unsupported file type: {path}")
+    return file_type
+
+# Standard search: quality and scale are continuous (on these grids). Full scale is
+# preferred; resolution is only traded once quality would drop below the floor.
+SEARCH_QUALITIES = list(range(10, 96))
+SEARCH_SCALES = [n / 100 for n in range(20, 101)]
+SEARCH_QUALITY_FLOOR = 40
+# A fit this close below the target ends the search
+SEARCH_TOLERANCE = 0.03
+MAX_SEARCH_TRIALS = 8
+
+class _SearchExhausted(Exception):
+    """
+    Raised inside the standard search once MAX_SEARCH_TRIALS trials have run.
+    """
+
+def _crossing(a, b, target, axis, value):
+    """
+    Position on `axis` where the line through measured points a and b, (x, size)
+    pairs in (axis(x), value(size)) space, reaches value(target).
+    """
+    (xa, sa), (xb, sb) = a, b
+    if value(sb) == value(sa):
+        return (axis(xa) + axis(xb)) / 2
+    return axis(xa) + (value(target) - value(sa)) * (axis(xb) - axis(xa)) / (value(sb) - value(sa))
+
+def _solve_fit(measure, target, grid, axis, value, guess=None, known=None):
+    """
+    Largest x on the sorted `grid` whose size fits `target`, for a size that grows
+    with x. `measure(x)` runs a trial and returns the size. Each step measures
+    the grid point where the secant through the two nearest measured points, in
+    (axis(x), value(size)) space, predicts the target; when the same end of the
+    bracket has held twice in a row, its midpoint is measured instead.
+    `guess` is measured first (default: grid[-1]); `known` ({x: size}) are
+    points measured earlier. Returns (x, size), or None if nothing fits.
+    """
+    points = dict(known or {})
+    x = grid[-1] if guess is None else max([g for g in grid if g <= guess] or grid[:1])
+    last_fit, same_side = None, 0
+    while True:
+        if x not in points:
+            points[x] = measure(x)
+            fit = points[x] <= target
+            same_side = same_side + 1 if fit == last_fit else 1
+            last_fit = fit
+        lo = max(((px, size) for px, size in points.items() if size <= target), default=None)
+        hi = min(((px, size) for px, size in points.items() if size > target), default=None)
+        if lo is not None and (lo[0] == grid[-1] or lo[1] >= target * (1 - SEARCH_TOLERANCE)):
+            return lo
+        inner = [g for g in grid if (lo is None or g > lo[0]) and (hi is None or g < hi[0])]
+        if not inner:
+            return lo
+        if lo is not None and hi is not None:
+            if same_side >= 2:
+                x, same_side = inner[len(inner) // 2], 0
+                continue
+            crossing = _crossing(lo, hi, target, axis, value)
+        else:
+            # One-sided: extrapolate from the two measured points nearest the open end
+            ordered = sorted(points.items())
+            pair = ordered[:2] if lo is None else ordered[-2:]
+            if len(pair) < 2:
+                x = inner[0] if lo is None else inner[-1]
+                continue
+            crossing = _crossing(pair[0], pair[1], target, axis, value)
+        below = [g for g in inner if axis(g) <= crossing]
+        x = below[-1] if below else inner[0]
+
+def _joint_search(measure, target, overhead=0, seed=None):
     """
-    original_size = get_file_size_mb(input_path)
-    if original_size <= target_size_mb:
+    Standard quality/scale search. `measure(quality, scale)` runs one trial and
+    returns the size in bytes. Finds, in order of preference:
+      1. the highest quality that fits at full scale, down to SEARCH_QUALITY_FLOOR
+         (secant steps on log size against quality),
+      2. the largest scale that fits at the floor quality (secant steps on size
+         against pixel count, starting from the scale the pixel count model
+         predicts after removing `overhead`),
+      3. the highest quality below the floor that fits at the smallest scale.
+    A cached result for the same input (`seed`) is measured first. Stops after
+    MAX_SEARCH_TRIALS trials. Returns the best (quality, scale, size) or None.
+    """
+    sizes = {}
+
+    def size_at(quality, scale):
+        if (quality, scale) not in sizes:
+            if len(sizes) >= MAX_SEARCH_TRIALS:
+                raise _SearchExhausted()
+            sizes[quality, scale] = measure(quality, scale)
+        return sizes[quality, scale]
+
+    def best_fit():
+        fits = [(scale, quality, size) for (quality, scale), size in sizes.items() if size <= target]
+        if not fits:
+            return None
+        scale, quality, size = max(fits)
+        return quality, scale, size
+
+    floor = SEARCH_QUALITY_FLOOR
+    full_qualities = [q for q in SEARCH_QUALITIES if q >= floor]
+    smallest = SEARCH_SCALES[0]
+    seed_q = seed_s = None
+    if seed and seed.get("found_fit") and seed.get("quality") is not None:
+        seed_q, seed_s = seed["quality"], seed.get("scale") or 1.0
+    # A smaller target cannot fit at full scale if a larger one already needed downscaling
+    skip_full = seed_s is not None and seed_s < 1.0 and target <= seed["target_size_mb"] * 1024 * 1024
+    try:
+        # 1. Quality at full scale
+        if not skip_full:
+            fit = _solve_fit(lambda q: size_at(q, 1.0), target, full_qualities, float, math.log,
+                             guess=seed_q if seed_s == 1.0 and seed_q >= floor else None)
+            if fit is not None:
+                return best_fit()
+
+        # 2. Scale at the floor quality; media bytes follow the pixel count, scale squared
+        base = sizes.get((floor, 1.0))
+        guess = seed_s if seed_s is not None and seed_s < 1.0 else None
+        if base is not None:
+            media = max(base - overhead, 1)
+            guess = math.sqrt(max(target - overhead, 0) / media)
+        fit = _solve_fit(lambda scale: size_at(floor, scale), target, SEARCH_SCALES,
+                         lambda scale: scale * scale, float,
+                         guess=guess if guess is not None else smallest,
+                         known={1.0: base} if base is not None else None)
+        if fit is not None:
+            return best_fit()
+
+        # 3. Quality below the floor at the smallest scale
+        low_qualities = [q for q in SEARCH_QUALITIES if q <= floor]
+        _solve_fit(lambda q: size_at(q, smallest), target, low_qualities, float, math.log,
+                   guess=low_qualities[0], known={floor: sizes[floor, smallest]}
+                   if (floor, smallest) in sizes else None)
+    except _SearchExhausted:
+        pass
+    return best_fit()
+
+# --- Pre-flight analysis ---
+# Largest unique images encoded at the smallest search settings to estimate the floor
+ANALYSIS_SAMPLES = 3
+# Estimates within this fraction of the target still get a full search
+ANALYSIS_MARGIN = 0.10
+
+@dataclass
+class FileAnalysis:
+    """
+    Size breakdown of a file, as estimated by analyze_file. Sizes are in bytes.
+    """
+    input_path: str
+    file_type: str
+    size: int
+    overhead: int = 0  # what the search cannot shrink: XML, fonts, page content, container
+    media: int = 0  # unique images the search re-encodes
+    duplicates: int = 0  # identical copies of images, stored once in the output
+    images: list = field(default_factory=list)  # (name, bytes) per unique image, largest first
+    sampled: int = 0
+    min_ratio: float = 1.0  # encoded / original bytes of the samples at the smallest settings
+    elapsed: float = 0.0
+
+    @property
+    def min_size(self):
+        """
+        Estimated size at the smallest quality and scale the search tries.
+        """
+        return self.overhead + int(self.media * self.min_ratio)
+
+    def reachable(self, target_bytes, margin=ANALYSIS_MARGIN):
+        """
+        False when even the smallest settings are expected to miss target_bytes by
+        more than `margin`.
+        """
+        return self.min_size <= target_bytes * (1 + margin)
+
+    def summary(self):
+        kb = lambda n: f"{n / 1024:,.0f} KB"
+        lines = [f"Fixed overhead: {kb(self.overhead)}",
+                 f"Images: {kb(self.media)} in {len(self.images)} image(s)"]
+        if self.duplicates:
+            lines.append(f"Duplicate images removed: {kb(self.duplicates)}")
+        if self.images:
+            lines.append("Largest: " + ", ".join(f"{posixpath.basename(name)} {kb(size)}"
+                                                for name, size in self.images[:3]))
+        lines.append(f"Smallest reachable: about {kb(self.min_size)}")
+        return "\n".join(lines)
+
+    def to_dict(self):
+        return dict(asdict(self), min_size=self.min_size)
+
+def _sample_ratio(samples, encode):
+    """
+    Byte-weighted encoded / original ratio of `samples` ([(original bytes, source)]),
+    with `encode(source)` returning the smallest encoding's size or None.
+    """
+    before = after = 0
+    for size, source in samples:
+        encoded = encode(source)
+        before += size
+        after += size if encoded is None else min(size, encoded)
+    return after / before if before else 1.0
+
+def _analyze_package(analysis, samples, resample, cancel=None):
+    """
+    Reads the ZIP central directory; duplicates are found by CRC and size, as
+    content hashes would need the data. Only the sampled images and stored
+    (uncompressed) parts that OfficePackage would deflate are read.
+    """
+    quality, scale = SEARCH_QUALITIES[0], SEARCH_SCALES[0]
+    repacked = 0
+    with zipfile.ZipFile(analysis.input_path) as zf:
+        seen = {}
+        for info in zf.infolist():
+            _check_cancel(cancel)
+            if not is_media_part(info.filename):
+                level = ZIP_LEVELS.get(entry_class(info.filename))
+                if info.compress_type == zipfile.ZIP_STORED and level is not None:
+                    packed = PackedData.pack(zf.read(info.filename), level)
+                    repacked += max(0, info.compress_size - len(packed.raw))
+                continue
+            key = (info.CRC, info.file_size)
+            if key in seen:
+                # The dropped copy takes its local header and directory entry with it
+                analysis.duplicates += info.compress_size + _LOCAL_HEADER.size + _CENTRAL_HEADER.size \
+                    + 2 * len(info.filename.encode("utf-8"))
+                continue
+            seen[key] = info
+            analysis.media += info.compress_size
+            analysis.images.append((info.filename, info.compress_size))
+        analysis.images.sort(key=lambda image: -image[1])
+        picked = [(size, name) for name, size in analysis.images[:samples]]
+
+        def encode(name):
+            _check_cancel(cancel)
+            data = zf.read(name)
+            try:
+                return len(encode_image(data, quality, scale, media_format(data), resample))
+            except Exception:
+                return None
+
+        analysis.sampled = len(picked)
+        analysis.min_ratio = _sample_ratio(picked, encode)
+    analysis.overhead = analysis.size - analysis.media - analysis.duplicates - repacked
+
+def _analyze_pdf(analysis, samples, resample, cancel=None):
+    """
+    Walks the cross-reference table object by object, releasing each once its
+    dictionary is read, so memory stays flat; image streams are never decoded.
+    Encrypted PDFs are opened with the empty user password, like PdfImageIndex
+    does; owner-restricted files need nothing else.
+    """
+    quality, scale = SEARCH_QUALITIES[0], SEARCH_SCALES[0]
+    with open(analysis.input_path, "rb") as f:
+        reader = PdfReader(f, strict=False)
+        if reader.is_encrypted and not reader.decrypt(""):
+            raise ValueError("Cannot analyze a password-protected PDF")
+        refs, digests = {}, set()
+        for idnum, generation in sorted(_pdf_generations(reader).items()):
+            _check_cancel(cancel)
+            try:
+                obj = reader.get_object(IndirectObject(idnum, generation, reader))
+            except Exception:
+                obj = None
+            if (isinstance(obj, StreamObject) and obj.get("/Subtype") == "/Image"
+                    and _is_replaceable_image(obj)):
+                digest = _pdf_image_digest(obj)
+                if digest in digests:
+                    analysis.duplicates += len(obj._data)
+                else:
+                    digests.add(digest)
+                    analysis.media += len(obj._data)
+                    analysis.images.append((f"object {idnum}", len(obj._data)))
+                    refs[f"object {idnum}"] = IndirectObject(idnum, generation, reader)
+            reader.resolved_objects.clear()
+        analysis.images.sort(key=lambda image: -image[1])
+        picked = [(size, refs[name]) for name, size in analysis.images[:samples]]
+
+        def encode(ref):
+            _check_cancel(cancel)
+            encoded = _encode_pdf_image(reader.get_object(ref), quality, scale, resample)
+            return None if encoded is None else len(encoded[0])
+
+        analysis.sampled = len(picked)
+        analysis.min_ratio = _sample_ratio(picked, encode)
+    analysis.overhead = analysis.size - analysis.media - analysis.duplicates
+
+def _floor_search(measure, target, overhead=0, seed=None):
+    """
+    Search for targets the pre-flight analysis expects to be out of reach: one trial
+    at the smallest settings, then the full _joint_search only if it fits after all.
+    """
+    if measure(SEARCH_QUALITIES[0], SEARCH_SCALES[0]) <= target:
+        return _joint_search(measure, target, overhead, seed)
+    return None
+
+def analyze_file(input_path, file_type=None, samples=ANALYSIS_SAMPLES, resample=DEFAULT_RESAMPLE,
+                 cancel=None):
+    """
+    Fast pre-flight pass: splits a file into fixed overhead, re-encodable image bytes
+    and duplicates, and estimates the smallest size the search can reach by
+    encoding the `samples` largest images at the smallest quality and scale.
+    Reads the ZIP central directory or the PDF object dictionaries, never the whole
+    document. `cancel` is checked per entry or object and per sample.
+    Returns a FileAnalysis.
+    """
+    started = time.perf_counter()
+    file_type = file_type or file_type_for(input_path)
+    analysis = FileAnalysis(input_path, file_type, os.path.getsize(input_path))
+    if file_type == "pdf":
+        _analyze_pdf(analysis, samples, resample, cancel)
+    else:
+        _analyze_package(analysis, samples, resample, cancel)
+    analysis.elapsed = time.perf_counter() - started
+    return analysis
+
+def compress_file(input_path, output_path, target_size_mb, file_type=None,
+                  encode_cache=None, processes=None, result_cache=None,
+                  progress=None, cancel=None, time_budget=None, mode="standard",
+                  resample=DEFAULT_RESAMPLE, memory_limit=None, analysis=None,
+                  pixel_budget=PIXEL_CACHE_BYTES):
+    """
+    High-precision search over an in-memory package for maximum speed and accuracy.
+    Returns a CompressionResult; `processes` is passed to the PDF engine.
+
+    `mode` is one of SEARCH_MODES. The perceptual modes ("perceptual", "allocate")
+    need NumPy and apply to docx/xlsx, where package size is exactly additive over
+    images; PDFs always use the standard search.
+
+    With a `result_cache` (result_cache.ResultCache), a previous result for the same
+    content, type and target is returned without searching, and a result for a
+    nearby target seeds the search.
+
+    `progress` is called with event dicts keyed by "event":
+      trial_start    trial, max_trials, quality, scale
+      image_encoded  trial, done, total
+      trial_end      trial, quality, scale, size_mb, fits, best ({quality, scale, size_mb} or None),
+                     plus score (mean SSIM) in the perceptual modes
+      phase          phase, seconds
+      analysis       overhead, media, duplicates, min_size (bytes), reachable
+      deadline       trials
+    `cancel` is a CancelToken checked between images and trials; when it fires,
+    CompressionCancelled is raised and no output is written.
+
+    `resample` names the RESAMPLE_FILTERS entry used for downscaled images.
+    `memory_limit` (bytes) switches PDFs to the streaming engine (stream_compress_pdf):
+    each trial is written to a spool file instead of being held in memory.
+    `pixel_budget` (bytes, 0 to disable) caps the PixelCache that keeps decoded
+    images across trials; the streaming engine never caches pixels.
+
+    The search starts with a pre-flight analyze_file pass (or uses `analysis`, a
+    FileAnalysis of the same input). When the target is below the estimated
+    smallest reachable size, a single trial at the smallest settings replaces the
+    search and any perceptual mode. If the analysis fails, the full search runs
+    without it.
+
+    With `time_budget` (seconds), the search stops once the budget is spent and
+    writes the best fit found so far (or the smallest attempt, or a copy of the
+    input if no trial finished). The analysis and loading phases count against the
+    budget too. result.converged tells whether the search ran to completion.
+    """
+    started = time.perf_counter()
+    file_type = file_type or file_type_for(input_path)
+    if mode not in SEARCH_MODES:
+        raise ValueError(f"Unknown search mode: {mode}")
+    if resample not in RESAMPLE_FILTERS:
+        raise ValueError(f"Unknown resampling filter: {resample}")
+    if file_type == 'pdf':
+        mode = "standard"
+    result = CompressionResult(input_path, output_path, file_type, target_size_mb,
+                               original_size_mb=get_file_size_mb(input_path), mode=mode)
+    # Results from different search modes and filters are cached separately
+    cache_type = file_type if mode == "standard" else f"{file_type}.{mode}"
+    if resample != DEFAULT_RESAMPLE:
+        cache_type += f".{resample}"
+    if result.original_size_mb <= target_size_mb:
         shutil.copy2(input_path, output_path)
-        return "Already under target"
+        result.status = "already_under_target"
+        result.final_size_mb = result.original_size_mb
+        result.elapsed = time.perf_counter() - started
+        return result
+
+    seed = None
+    if result_cache is not None:
+        digest = file_digest(input_path)
+        hit = result_cache.lookup(digest, cache_type, target_size_mb)
+        if hit is not None:
+            try:
+                shutil.copyfile(hit[0], output_path)
+            except OSError:
+                hit = None  # evicted by another worker in the meantime
+        if hit is not None:
+            record = hit[1]
+            result.quality, result.scale = record["quality"], record["scale"]
+            result.found_fit, result.status = record["found_fit"], record["status"]
+            result.cache_hit = True
+            result.final_size_mb = get_file_size_mb(output_path)
+            result.elapsed = time.perf_counter() - started
+            return result
+        seed = result_cache.nearest(digest, cache_type, target_size_mb)
 
     best_q = 5
     best_scale = 0.2
     found_fit = False
+    trials = 0
+    max_trials = len(PERCEPTUAL_GRID) if mode != "standard" else MAX_SEARCH_TRIALS
+    timer = PhaseTimer(progress)
+    target_bytes = target_size_mb * 1024 * 1024
+    best = None
+    wrote_output = False
+    stop = cancel
+    if time_budget is not None:
+        stop = _DeadlineToken(time.monotonic() + time_budget - (time.perf_counter() - started), cancel)
+
+    def start_trial(quality, scale):
+        nonlocal trials
+        _check_cancel(stop)
+        trials += 1
+        _emit(progress, "trial_start", trial=trials, max_trials=max_trials, quality=quality, scale=scale)
+        return lambda done, total: _emit(progress, "image_encoded", trial=trials, done=done, total=total)
+
+    with timer.phase("analyze"):
+        if analysis is None:
+            try:
+                analysis = analyze_file(input_path, file_type, resample=resample, cancel=stop)
+            except CompressionCancelled:
+                raise
+            except _DeadlineReached:
+                pass  # out of time: the load below stops at once and the input is kept
+            except Exception as e:
+                # The analysis only shortens the search; without it the full search runs
+                logging.warning("Pre-flight analysis of %s failed: %s", input_path, e)
+    reachable = analysis is None or analysis.reachable(target_bytes)
+    if analysis is not None:
+        result.estimated_min_mb = analysis.min_size / (1024 * 1024)
+        _emit(progress, "analysis", overhead=analysis.overhead, media=analysis.media,
+              duplicates=analysis.duplicates, min_size=analysis.min_size, reachable=reachable)
+    search = _joint_search if reachable else _floor_search
+    if not reachable:
+        max_trials = 1
+
+    def rank(trial):
+        return trial.get("score", 0), trial["scale"], trial["quality"]
+
+    def end_trial(quality, scale, size, fits, **extra):
+        nonlocal best
+        trial = dict({"quality": quality, "scale": scale, "size_mb": size / (1024 * 1024)}, **extra)
+        if fits and (best is None or rank(trial) >= rank(best)):
+            best = trial
+        _emit(progress, "trial_end", trial=trials, quality=quality, scale=scale,
+              size_mb=size / (1024 * 1024), fits=fits, best=best, **extra)
     
-    # 1. Setup Master Temp (Extract Once)
+    # 1. Load the package once; non-media parts are carried over as raw compressed bytes
     if file_type in ['docx', 'xlsx']:
-        with tempfile.TemporaryDirectory() as master_temp:
-            with zipfile.ZipFile(input_path, 'r') as zip_ref:
-                zip_ref.extractall(master_temp)
-            
-            # Identify all media folders
-            media_dirs = []
-            for root, dirs, files in os.walk(master_temp):
-                if root.endswith('media'):
-                    media_dirs.append(root)
-
-            # Create a backup of original images to avoid cumulative loss / re-extraction
-            backup_temp = tempfile.mkdtemp()
-            for m_dir in media_dirs:
-                rel_path = os.path.relpath(m_dir, master_temp)
-                shutil.copytree(m_dir, os.path.join(backup_temp, rel_path))
-
-            # Smart Search: Try scales from 1.0 down to 0.25
-            for scale in [1.0, 0.75, 0.5, 0.25]:
-                low_q, high_q = 10, 95
-                for _ in range(5): # Binary search across quality
-                    mid_q = (low_q + high_q) // 2
-                    
-                    # Restore clean images from backup
-                    for m_dir in media_dirs:
-                        rel_path = os.path.relpath(m_dir, master_temp)
-                        shutil.rmtree(m_dir)
-                        shutil.copytree(os.path.join(backup_temp, rel_path), m_dir)
-                        parallel_compress_images(m_dir, mid_q, scale)
-
-                    # Re-zip efficiently
-                    with zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED) as zip_ref:
-                        for root, dirs, files in os.walk(master_temp):
-                            for file in files:
-                                f_path = os.path.join(root, file)
-                                zip_ref.write(f_path, os.path.relpath(f_path, master_temp))
-
-                    current_size = get_file_size_mb(output_path)
-                    if current_size <= target_size_mb:
-                        best_q, best_scale = mid_q, scale
-                        low_q = mid_q + 1
-                        found_fit = True
-                    else:
-                        high_q = mid_q - 1
-                
-                if found_fit: break # If we hit target at this scale, stop scaling down
-
-            # Cleanup backup
-            shutil.rmtree(backup_temp)
-
-            # Ensure final output is the best fit
-            # If not found_fit, we've already written the last (most aggressive) attempt to output_path.
-            # If found_fit, we might need a final pass if mid_q wasn't best_q.
-            if found_fit and mid_q != best_q:
-                 for m_dir in media_dirs:
-                    # Logic here would be slightly redundant but ensures 100% accuracy.
-                    # Given binary search, the last 'current_size <= target_size_mb' iteration wrote to output_path.
-                    pass
+        package = None
+        try:
+            with timer.phase("load"):
+                package = OfficePackage(input_path, resample=resample, pixel_budget=pixel_budget, cancel=stop)
+                overhead = package.fixed_overhead()
+        except _DeadlineReached:
+            result.converged = False
+            _emit(progress, "deadline", trials=trials)
+        cache = encode_cache if encode_cache is not None else EncodedImageCache()
+        smallest = None
+
+        if package is None:
+            pass  # the budget ran out while loading; the input is copied below
+        elif mode != "standard" and reachable:
+            settings, result.score, found_fit, result.converged = _perceptual_office_search(
+                package, cache, overhead, target_bytes, mode == "allocate",
+                start_trial, end_trial, stop, timer)
+            if not result.converged:
+                _emit(progress, "deadline", trials=trials)
+            # Report the settings of the largest image
+            largest = max(package.media, key=lambda part: len(part.raw), default=None)
+            best_q, best_scale = settings.get(largest.digest, (None, 1.0)) if largest else (None, 1.0)
+            with timer.phase("encode"):
+                encoded = package.encode_media(None, 1.0, cache, cancel=cancel, per_image=settings)
+            with timer.phase("write"):
+                package.write(output_path, encoded)
+            wrote_output = True
+
+        else:
+            def measure(quality, scale):
+                nonlocal smallest
+                on_image = start_trial(quality, scale)
+                # Score the trial from memoized encoded sizes; nothing is written yet
+                with timer.phase("encode"):
+                    encoded = package.encode_media(quality, scale, cache, on_image=on_image, cancel=stop)
+                with timer.phase("size_check"):
+                    size = overhead + sum(len(packed.raw) for packed in encoded.values())
+                if smallest is None or size < smallest[0]:
+                    smallest = (size, quality, scale)
+                end_trial(quality, scale, size, size <= target_bytes)
+                return size
+
+            try:
+                search(measure, target_bytes, overhead, seed)
+            except _DeadlineReached:
+                result.converged = False
+                _emit(progress, "deadline", trials=trials)
+
+            # Write the archive exactly once: the best fit, or the smallest attempt if nothing fit.
+            # The winning encodings are memoized, so this pass is not interrupted by the deadline.
+            found_fit = best is not None
+            if found_fit:
+                best_q, best_scale = best["quality"], best["scale"]
+            elif smallest is not None:
+                best_q, best_scale = smallest[1:]
+            if found_fit or smallest is not None:
+                with timer.phase("encode"):
+                    encoded = package.encode_media(best_q, best_scale, cache, cancel=cancel)
+                with timer.phase("write"):
+                    package.write(output_path, encoded)
+                wrote_output = True
 
     else:
-        # PDF logic follows similar multi-pass logic
-        for scale in [1.0, 0.75, 0.5, 0.25]:
-            low_q, high_q = 10, 95
-            for _ in range(5):
-                mid_q = (low_q + high_q) // 2
-                compress_pdf(input_path, output_path, quality=mid_q, scale=scale)
-                current_size = get_file_size_mb(output_path)
-                if current_size <= target_size_mb:
-                    best_q, best_scale = mid_q, scale
-                    low_q = mid_q + 1
-                    found_fit = True
-                else:
-                    high_q = mid_q - 1
-            if found_fit: break
+        # PDF logic follows the same search over a document parsed once. With a memory
+        # limit every trial is streamed from disk into a spool file next to the output.
+        best_data = smallest = None
+        if memory_limit is None:
+            try:
+                with timer.phase("load"):
+                    index = PdfImageIndex(input_path, processes=processes, resample=resample,
+                                          pixel_budget=pixel_budget, cancel=stop)
+            except _DeadlineReached:
+                index = None
+            spool_dir = None
+        else:
+            index = nullcontext()
+            spool_dir = tempfile.mkdtemp(prefix="office_tools_trials_",
+                                         dir=os.path.dirname(os.path.abspath(output_path)))
 
-    return f"Target Met: {found_fit} (Q:{best_q} S:{best_scale})"
+        def measure(quality, scale):
+            nonlocal best_data, smallest
+            on_image = start_trial(quality, scale)
+            if spool_dir is None:
+                with timer.phase("encode"):
+                    index.apply(quality, scale, on_image=on_image, cancel=stop)
+                with timer.phase("write"):
+                    out = io.BytesIO()
+                    index.write(out)
+                data = out.getvalue()
+                size = len(data)
+            else:
+                data = os.path.join(spool_dir, f"trial-{trials}.pdf")
+                with timer.phase("encode"):
+                    size = stream_compress_pdf(input_path, data, quality, scale, memory_limit,
+                                               on_object=on_image, cancel=stop, resample=resample)
+            previous = (best_data, smallest and smallest[0])
+            if smallest is None or size < smallest[1]:
+                smallest = (data, size, quality, scale)
+            end_trial(quality, scale, size, size <= target_bytes)
+            if best is not None and (best["quality"], best["scale"]) == (quality, scale):
+                best_data = data
+            if spool_dir is not None:
+                # Only the best fit and the smallest attempt stay on disk
+                for path in set(previous + (data,)) - {best_data, smallest[0], None}:
+                    os.remove(path)
+            return size
 
-def convert_pdf_to_word(input_pdf, output_docx):
+        try:
+            with index or nullcontext():
+                try:
+                    if index is None:
+                        raise _DeadlineReached()  # the budget ran out while loading
+                    search(measure, target_bytes, analysis.overhead if analysis else 0, seed)
+                except _DeadlineReached:
+                    result.converged = False
+                    _emit(progress, "deadline", trials=trials)
+
+            # Every finished trial is kept, so a valid output always exists
+            found_fit = best is not None
+            if found_fit:
+                best_q, best_scale = best["quality"], best["scale"]
+            elif smallest is not None:
+                best_data, _, best_q, best_scale = smallest
+            if best_data is not None:
+                with timer.phase("write"):
+                    if spool_dir is not None:
+                        os.replace(best_data, output_path)
+                    else:
+                        with open(output_path, "wb") as out_f:
+                            out_f.write(best_data)
+                wrote_output = True
+        finally:
+            if spool_dir is not None:
+                shutil.rmtree(spool_dir, ignore_errors=True)
+
+    if wrote_output:
+        result.quality, result.scale = best_q, best_scale
+    else:
+        # The budget ran out before any trial finished: the input is the only valid output
+        shutil.copy2(input_path, output_path)
+    result.trials = trials
+    result.phases = timer.durations
+    result.found_fit = found_fit
+    result.status = "target_met" if found_fit else "target_missed"
+    result.final_size_mb = get_file_size_mb(output_path)
+    if result_cache is not None and result.converged:
+        result_cache.store(digest, cache_type, target_size_mb, output_path,
+                           {"quality": best_q, "scale": best_scale, "found_fit": found_fit,
+                            "status": result.status})
+    result.elapsed = time.perf_counter() - started
+    return result
+
+def iterative_compress(input_path, output_path, target_size_mb, file_type, encode_cache=None,
+                       progress=None, cancel=None, time_budget=None, mode="standard", analysis=None):
     """
-    Converts a PDF file to a Word (.docx) file with lazy loading to prevent startup crashes.
+    Compresses input_path to at most target_size_mb and returns a summary message.
+    See compress_file for the `progress` events, `cancel` token, `time_budget`, `mode`
+    and `analysis`.
     """
+    return compress_file(input_path, output_path, target_size_mb, file_type, encode_cache,
+                         progress=progress, cancel=cancel, time_budget=time_budget, mode=mode,
+                         analysis=analysis).message
+
+# Pages per conversion task: small enough for steady progress, large enough that
+# each task's document analysis (fonts, headers, margins) sees some context
+CONVERT_SHARD_PAGES = 8
+
+def _import_converter():
     try:
         from pdf2docx import Converter
-        cv = Converter(input_pdf)
-        cv.convert(output_docx, start=0, end=None)
-        cv.close()
-        return True
+        return Converter
     except ImportError as e:
         if "DLL load failed" in str(e):
             raise Exception("PDF to Word conversion is unavailable because some system dependencies (MSVC Redistributables) are missing. Please install the latest Microsoft Visual C++ Redistributable or use the File Compressor feature.")
         raise e
+
+def conversion_pages(page_count, start=0, end=None, pages=None):
+    """
+    Zero-based page indexes to convert: `pages` if given, else the range start..end
+    (end exclusive, None for the last page). Out-of-range indexes are dropped.
+    """
+    if pages is not None:
+        return sorted({int(i) for i in pages if 0 <= int(i) < page_count})
+    return list(range(page_count)[slice(int(start or 0), end)])
+
+def _convert_worker(input_pdf, pages, json_path):
+    """
+    Parses one shard of pages in a worker process and stores the layout as JSON.
+    """
+    Converter = _import_converter()
+    cv = Converter(input_pdf)
+    try:
+        settings = cv.default_settings
+        cv.load_pages(pages=pages).parse_document(**settings).parse_pages(**settings)
+        cv.serialize(json_path)
+    finally:
+        cv.close()
+    return len(pages)
+
+def convert_pdf_to_word(input_pdf, output_docx, start=0, end=None, pages=None, workers=1,
+                        on_page=None, cancel=None):
+    """
+    Converts a PDF file to a Word (.docx) file with lazy loading to prevent startup crashes.
+
+    Only the pages selected by start/end or `pages` (zero-based, see conversion_pages)
+    are converted. With workers > 1 the pages are split into shards of
+    CONVERT_SHARD_PAGES, parsed in separate processes and merged into one document.
+    on_page(done, total) is called as pages are parsed; `cancel` is checked between
+    pages or shards.
+    """
+    Converter = _import_converter()
+    try:
+        cv = Converter(input_pdf)
+        try:
+            settings = cv.default_settings
+            indexes = conversion_pages(len(cv.fitz_doc), start, end, pages)
+            if not indexes:
+                raise ValueError("No pages selected")
+            cv.load_pages(pages=indexes)
+            shards = [indexes[i:i + CONVERT_SHARD_PAGES] for i in range(0, len(indexes), CONVERT_SHARD_PAGES)]
+            workers = max(1, min(workers or os.cpu_count() or 1, len(shards)))
+            if workers == 1:
+                cv.parse_document(**settings)
+                for done, index in enumerate(indexes, 1):
+                    _check_cancel(cancel)
+                    try:
+                        cv.pages[index].parse(**settings)
+                    except Exception as e:
+                        # Same policy as pdf2docx: a broken page is left out, not fatal
+                        logging.error("Ignoring page %d: %s", index + 1, e)
+                    if on_page is not None:
+                        on_page(done, len(indexes))
+            else:
+                with tempfile.TemporaryDirectory(prefix="office_tools_convert_") as work_dir, \
+                        ProcessPoolExecutor(max_workers=workers) as executor:
+                    futures = [executor.submit(_convert_worker, input_pdf, shard,
+                                               os.path.join(work_dir, f"shard{n}.json"))
+                               for n, shard in enumerate(shards)]
+                    done = 0
+                    try:
+                        for future in futures:
+                            _check_cancel(cancel)
+                            done += future.result()
+                            if on_page is not None:
+                                on_page(done, len(indexes))
+                    except BaseException:
+                        for future in futures:
+                            future.cancel()
+                        raise
+                    for n in range(len(shards)):
+                        cv.deserialize(os.path.join(work_dir, f"shard{n}.json"))
+            _check_cancel(cancel)
+            cv.make_docx(output_docx, **settings)
+        finally:
+            cv.close()
+        return True
+    except CompressionCancelled:
+        raise
     except Exception as e:
         raise Exception(f"Conversion failed: {str(e)}")
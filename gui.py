@@ -3,7 +3,63 @@ from tkinter import filedialog, messagebox, ttk, simpledialog
 import os
 import threading
 import sys
-from compressor import iterative_compress, get_file_size_mb, convert_pdf_to_word
+import time
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+# compressor pulls in PIL and pypdf, so it is imported by the workflows that need it
+# (and preloaded in the background once the window is up) rather than at startup
+def _preload_compressor():
+    try:
+        import compressor  # noqa: F401
+    except Exception:
+        pass  # reported when a workflow imports it
+
+# Compression jobs running at once. Their image work goes to compressor's shared
+# executor, which is sized to the cores, so more slots would only add memory.
+JOB_SLOTS = 2
+# Cells of the text progress bar drawn in the queue's Progress column
+PROGRESS_CELLS = 10
+_job_ids = itertools.count(1)
+
+class CompressionJob:
+    """
+    One file in the compression queue, with its status as shown in the queue view.
+    Updated only on the Tk thread.
+    """
+    def __init__(self, input_path, output_path, target_kb, analysis=None):
+        self.iid = f"job{next(_job_ids)}"
+        self.input_path = input_path
+        self.output_path = output_path
+        self.target_kb = target_kb
+        self.analysis = analysis
+        self.cancel_token = None
+        self.future = None
+        self.status = "Queued"
+        self.detail = ""
+        self.progress = 0.0
+        self.max_trials = 1
+        self.started = None
+        self.elapsed = None
+
+    @property
+    def finished(self):
+        return self.status in ("Done", "Missed target", "Failed", "Cancelled")
+
+    def row(self):
+        elapsed = self.elapsed
+        if elapsed is None and self.started is not None:
+            elapsed = time.perf_counter() - self.started
+        return (os.path.basename(self.input_path), f"{self.target_kb:.0f} KB", self.status,
+                self.progress_bar(), self.detail, "" if elapsed is None else f"{elapsed:.1f}s")
+
+    def progress_bar(self):
+        # Treeview cells cannot hold widgets, so running jobs get a bar drawn in text
+        if self.started is None or self.finished:
+            return ""
+        fraction = min(self.progress, 1.0)
+        filled = round(fraction * PROGRESS_CELLS)
+        return "\u2588" * filled + "\u2591" * (PROGRESS_CELLS - filled) + f" {fraction:.0%}"
 
 class OfficeToolsApp:
     def __init__(self, root):
@@ -20,7 +76,25 @@ class OfficeToolsApp:
         self.main_container = tk.Frame(self.root, bg="#f8f9fa")
         self.main_container.pack(fill="both", expand=True)
 
+        # The compression queue outlives its view: jobs keep running on the home screen
+        self.jobs = []
+        self.job_runner = None
+        self.job_tree = None
+        self.tick_id = None
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+
         self.show_home()
+        self.root.after_idle(lambda: threading.Thread(target=_preload_compressor, daemon=True).start())
+
+    def bring_to_front(self):
+        """
+        Shows the window on top; used when a second launch hands over to this instance.
+        """
+        self.root.deiconify()
+        self.root.lift()
+        self.root.attributes("-topmost", True)
+        self.root.after_idle(self.root.attributes, "-topmost", False)
+        self.root.focus_force()
 
     def clear_container(self):
         for widget in self.main_container.winfo_children():
@@ -60,15 +134,13 @@ class OfficeToolsApp:
 
     def show_compressor(self):
         self.clear_container()
-        self.setup_action_view("File Compressor", "#007bff", self.run_compress_workflow)
+        self.setup_queue_view()
 
     def show_converter(self):
         self.clear_container()
         self.setup_action_view("PDF to Word Converter", "#28a745", self.run_convert_workflow)
 
-    def setup_action_view(self, title, color, action_cmd):
-        self.root.geometry("500x300")
-        
+    def _build_header(self, title, color):
         # Header
         header = tk.Frame(self.main_container, bg=color, height=60)
         header.pack(fill="x")
@@ -80,6 +152,10 @@ class OfficeToolsApp:
                             bd=0, cursor="hand2", command=self.show_home)
         back_btn.place(x=10, y=10)
 
+    def setup_action_view(self, title, color, action_cmd):
+        self.root.geometry("500x360")
+        self._build_header(title, color)
+
         # Content
         content = tk.Frame(self.main_container, bg="#f8f9fa", padx=30, pady=30)
         content.pack(fill="both", expand=True)
@@ -91,21 +167,129 @@ class OfficeToolsApp:
         self.progress = ttk.Progressbar(content, orient="horizontal", length=400, mode="indeterminate")
         self.progress.pack(pady=10)
 
+        self.detail_label = tk.Label(content, text="", font=("Segoe UI", 9),
+                                    bg="#f8f9fa", fg="#6c757d")
+        self.detail_label.pack()
+
         self.start_btn = tk.Button(content, text="START PROCESS", bg=color, fg="white",
                                   font=("Segoe UI", 10, "bold"), padx=20, pady=10, bd=0,
                                   cursor="hand2", command=action_cmd)
         self.start_btn.pack(pady=20)
 
-    # --- Compression Workflow ---
-    def run_compress_workflow(self):
-        input_path = filedialog.askopenfilename(
-            title="Select File to Compress",
+        # Only shown while a cancellable job is running
+        self.cancel_btn = tk.Button(content, text="CANCEL", bg="#dc3545", fg="white",
+                                   activebackground="#a71d2a", activeforeground="white",
+                                   font=("Segoe UI", 9, "bold"), padx=15, pady=5, bd=0,
+                                   cursor="hand2", command=self.cancel_action)
+        self.cancel_token = None
+
+    # --- Compression Queue ---
+    def setup_queue_view(self):
+        self.root.geometry("740x440")
+        self._build_header("File Compressor", "#007bff")
+
+        content = tk.Frame(self.main_container, bg="#f8f9fa", padx=20, pady=15)
+        content.pack(fill="both", expand=True)
+
+        toolbar = tk.Frame(content, bg="#f8f9fa")
+        toolbar.pack(fill="x", pady=(0, 10))
+        btn_style = {"font": ("Segoe UI", 9, "bold"), "padx": 12, "pady": 6, "bd": 0, "cursor": "hand2",
+                     "fg": "white"}
+        tk.Button(toolbar, text="ADD FILES", bg="#007bff", activebackground="#0056b3",
+                  command=self.add_jobs, **btn_style).pack(side="left")
+        tk.Button(toolbar, text="CANCEL SELECTED", bg="#dc3545", activebackground="#a71d2a",
+                  command=self.cancel_selected_jobs, **btn_style).pack(side="left", padx=8)
+        tk.Button(toolbar, text="CLEAR FINISHED", bg="#6c757d", activebackground="#495057",
+                  command=self.clear_finished_jobs, **btn_style).pack(side="left")
+
+        columns = (("file", "File", 180), ("target", "Target", 70), ("status", "Status", 90),
+                   ("progress", "Progress", 130), ("result", "Result", 160), ("time", "Time", 60))
+        self.job_tree = ttk.Treeview(content, columns=[c[0] for c in columns], show="headings", height=10)
+        for name, title, width in columns:
+            self.job_tree.heading(name, text=title)
+            self.job_tree.column(name, width=width, anchor="w" if name in ("file", "result") else "center")
+        self.job_tree.pack(fill="both", expand=True)
+
+        self.status_label = tk.Label(content, text="", font=("Segoe UI", 9), bg="#f8f9fa", fg="#6c757d")
+        self.status_label.pack(pady=(8, 0))
+
+        for job in self.jobs:
+            self.job_tree.insert("", "end", iid=job.iid, values=job.row())
+        self.refresh_queue_status()
+        if self.tick_id is not None:
+            self.root.after_cancel(self.tick_id)
+        self.tick_id = self.root.after(1000, self._tick_jobs)
+
+    def _queue_visible(self):
+        return self.job_tree is not None and self.job_tree.winfo_exists()
+
+    def _job_runner(self):
+        if self.job_runner is None:
+            self.job_runner = ThreadPoolExecutor(max_workers=JOB_SLOTS, thread_name_prefix="office_tools_job")
+        return self.job_runner
+
+    def add_jobs(self):
+        input_paths = filedialog.askopenfilenames(
+            title="Select Files to Compress",
             filetypes=[("Compressible files", "*.pdf *.docx *.xlsx")]
         )
-        if not input_path: return
+        if not input_paths: return
 
-        target_kb = simpledialog.askfloat("Target Size", "Enter target size in KB:", initialvalue=500.0, minvalue=10.0)
+        if len(input_paths) == 1:
+            self.analyze_single_job(input_paths[0])
+            return
+
+        target_kb = simpledialog.askfloat("Target Size", f"Enter target size in KB for {len(input_paths)} files:",
+                                          initialvalue=500.0, minvalue=10.0)
         if target_kb is None: return
+        output_dir = filedialog.askdirectory(title="Save Compressed Files In",
+                                             initialdir=os.path.dirname(input_paths[0]))
+        if not output_dir: return
+        for input_path in input_paths:
+            stem, ext = os.path.splitext(os.path.basename(input_path))
+            self.enqueue(CompressionJob(input_path, os.path.join(output_dir, f"{stem}_compressed{ext}"), target_kb))
+
+    def analyze_single_job(self, input_path):
+        """
+        Runs the pre-flight analysis on a worker thread, so a large file does not
+        freeze the window, and opens the prompts once it is done.
+        """
+        if self._queue_visible():
+            self.status_label.config(text=f"Analyzing {os.path.basename(input_path)}...")
+        threading.Thread(target=self.execute_analysis, args=(input_path,), daemon=True).start()
+
+    def execute_analysis(self, input_path):
+        analysis = error = None
+        try:
+            from compressor import analyze_file
+            analysis = analyze_file(input_path)
+        except Exception as e:
+            error = str(e)
+        self.root.after(0, lambda: self.on_analysis_complete(input_path, analysis, error))
+
+    def on_analysis_complete(self, input_path, analysis, error):
+        self.refresh_queue_status()
+        job = self.ask_single_job(input_path, analysis, error)
+        if job is not None:
+            self.enqueue(job)
+
+    def ask_single_job(self, input_path, analysis, error=None):
+        """
+        Pre-flight breakdown, target and output prompts for one file; returns a
+        CompressionJob or None if the user backs out. Without an `analysis` the
+        file is still queued, and compressed with a full search.
+        """
+        if analysis is not None:
+            prompt = f"{analysis.summary()}\n\nEnter target size in KB:"
+        else:
+            prompt = f"Size breakdown unavailable ({error}).\n\nEnter target size in KB:"
+        target_kb = simpledialog.askfloat("Target Size", prompt, initialvalue=500.0, minvalue=10.0)
+        if target_kb is None: return None
+        if analysis is not None and not analysis.reachable(target_kb * 1024) and not messagebox.askyesno(
+                "Target Out of Reach",
+                f"{target_kb:.0f} KB is below the smallest size this file is expected to reach "
+                f"(about {analysis.min_size / 1024:.0f} KB). Compress to the smallest size instead?"):
+            return None
 
         ext = os.path.splitext(input_path)[1]
         output_path = filedialog.asksaveasfilename(
@@ -114,24 +298,128 @@ class OfficeToolsApp:
             defaultextension=ext,
             filetypes=[("Compressed files", f"*{ext}")]
         )
-        if not output_path: return
+        if not output_path: return None
+        return CompressionJob(input_path, output_path, target_kb, analysis)
 
-        self.start_btn.config(state="disabled")
-        self.progress.start()
-        self.status_label.config(text="Compressing... Please wait.", fg="#007bff")
-        
-        threading.Thread(target=self.execute_compression, 
-                         args=(input_path, output_path, target_kb/1024.0, ext[1:].lower()), daemon=True).start()
+    def enqueue(self, job):
+        from compressor import CancelToken
+        job.cancel_token = CancelToken()
+        self.jobs.append(job)
+        if self._queue_visible():
+            self.job_tree.insert("", "end", iid=job.iid, values=job.row())
+        job.future = self._job_runner().submit(self.execute_job, job)
+        self.refresh_queue_status()
 
-    def execute_compression(self, input_path, output_path, target_mb, file_type):
+    def execute_job(self, job):
+        from compressor import CompressionCancelled, compress_file
+        if job.cancel_token.cancelled:
+            return
+        self.root.after(0, lambda: self.on_job_started(job))
+        started = time.perf_counter()
+        # Events arrive on the job thread; hand them to Tk's thread
+        on_event = lambda event: self.root.after(0, lambda: self.on_job_event(job, event))
         try:
-            res_msg = iterative_compress(input_path, output_path, target_mb, file_type)
-            final_size = get_file_size_mb(output_path) * 1024
-            orig_size = get_file_size_mb(input_path) * 1024
-            msg = f"Success!\n\nOriginal: {orig_size:.1f} KB\nCompressed: {final_size:.1f} KB\n({res_msg})"
-            self.root.after(0, lambda: self.on_action_complete(True, msg))
+            # Jobs share the cores through compressor's executor, so the PDF engine stays on threads
+            result = compress_file(job.input_path, job.output_path, job.target_kb / 1024.0, processes=1,
+                                   progress=on_event, cancel=job.cancel_token, analysis=job.analysis)
+            status = "Done" if result.found_fit else "Missed target"
+            detail = f"{result.final_size_mb * 1024:.1f} KB (Q:{result.quality} S:{result.scale})"
+        except CompressionCancelled:
+            status, detail = "Cancelled", "No file written"
         except Exception as e:
-            self.root.after(0, lambda: self.on_action_complete(False, str(e)))
+            status, detail = "Failed", str(e)
+        elapsed = time.perf_counter() - started
+        self.root.after(0, lambda: self.on_job_finished(job, status, detail, elapsed))
+
+    def on_job_started(self, job):
+        if not job.finished:
+            job.started = time.perf_counter()
+            job.status = "Cancelling..." if job.cancel_token.cancelled else "Running"
+            self.refresh_job(job)
+
+    def on_job_event(self, job, event):
+        if job.finished or job.cancel_token.cancelled:
+            return
+        kind = event["event"]
+        if kind == "trial_start":
+            job.max_trials = event["max_trials"]
+            job.progress = (event["trial"] - 1) / job.max_trials
+        elif kind == "analysis" and not event["reachable"]:
+            job.detail = f"Out of reach (min ~{event['min_size'] / 1024:.0f} KB)"
+        elif kind == "image_encoded" and event["total"]:
+            job.progress = (event["trial"] - 1 + event["done"] / event["total"]) / job.max_trials
+        elif kind == "trial_end" and event["best"]:
+            job.detail = f"Best so far: {event['best']['size_mb'] * 1024:.1f} KB"
+        self.refresh_job(job)
+
+    def on_job_finished(self, job, status, detail, elapsed):
+        job.status, job.detail, job.elapsed = status, detail, elapsed
+        self.refresh_job(job)
+
+    def refresh_job(self, job):
+        if self._queue_visible() and self.job_tree.exists(job.iid):
+            self.job_tree.item(job.iid, values=job.row())
+        self.refresh_queue_status()
+
+    def refresh_queue_status(self):
+        if not self._queue_visible():
+            return
+        running = sum(job.started is not None and not job.finished for job in self.jobs)
+        queued = sum(job.started is None and not job.finished for job in self.jobs)
+        if running or queued:
+            text = f"{running} running, {queued} queued (up to {JOB_SLOTS} at once)"
+        else:
+            text = "Add files to start compressing." if not self.jobs else "All jobs finished."
+        self.status_label.config(text=text)
+
+    def _tick_jobs(self):
+        # Keeps the Time column of running jobs current
+        self.tick_id = None
+        if not self._queue_visible():
+            return
+        for job in self.jobs:
+            if job.started is not None and not job.finished:
+                self.job_tree.item(job.iid, values=job.row())
+        self.tick_id = self.root.after(1000, self._tick_jobs)
+
+    def cancel_selected_jobs(self):
+        if not self._queue_visible():
+            return
+        selected = set(self.job_tree.selection())
+        for job in self.jobs:
+            if job.iid not in selected or job.finished:
+                continue
+            job.cancel_token.cancel()
+            if job.future.cancel() or job.started is None:
+                job.status, job.detail = "Cancelled", "Not started"
+            else:
+                job.status = "Cancelling..."
+            self.refresh_job(job)
+
+    def clear_finished_jobs(self):
+        finished = [job for job in self.jobs if job.finished]
+        for job in finished:
+            self.jobs.remove(job)
+            if self._queue_visible() and self.job_tree.exists(job.iid):
+                self.job_tree.delete(job.iid)
+        self.refresh_queue_status()
+
+    def on_close(self):
+        active = [job for job in self.jobs if not job.finished]
+        if active and not messagebox.askyesno("Quit", f"{len(active)} compression job(s) are still queued or "
+                                                      f"running. Cancel them and quit?"):
+            return
+        for job in active:
+            job.cancel_token.cancel()
+        if self.job_runner is not None:
+            self.job_runner.shutdown(wait=False, cancel_futures=True)
+        self.root.destroy()
+
+    def cancel_action(self):
+        if self.cancel_token is not None:
+            self.cancel_token.cancel()
+            self.cancel_btn.config(state="disabled")
+            self.status_label.config(text="Cancelling...", fg="#dc3545")
 
     # --- Conversion Workflow ---
     def run_convert_workflow(self):
@@ -149,24 +437,53 @@ class OfficeToolsApp:
         )
         if not output_path: return
 
+        from compressor import CancelToken
         self.start_btn.config(state="disabled")
-        self.progress.start()
+        self.progress.config(mode="determinate", maximum=100, value=0)
         self.status_label.config(text="Converting PDF to Word... This may take a moment.", fg="#28a745")
-        
-        threading.Thread(target=self.execute_conversion, args=(input_path, output_path), daemon=True).start()
+        self.cancel_token = CancelToken()
+        self.cancel_btn.pack()
+
+        threading.Thread(target=self.execute_conversion, args=(input_path, output_path, self.cancel_token),
+                         daemon=True).start()
 
-    def execute_conversion(self, input_path, output_path):
+    def execute_conversion(self, input_path, output_path, cancel_token):
+        from compressor import CompressionCancelled, convert_pdf_to_word
+        on_page = lambda done, total: self.root.after(0, lambda: self.on_convert_page(done, total))
         try:
-            convert_pdf_to_word(input_path, output_path)
+            convert_pdf_to_word(input_path, output_path, workers=os.cpu_count(), on_page=on_page,
+                                cancel=cancel_token)
             self.root.after(0, lambda: self.on_action_complete(True, "PDF successfully converted to Word!"))
+        except CompressionCancelled:
+            self.root.after(0, lambda: self.on_action_complete(None, "Conversion cancelled. No file was written."))
         except Exception as e:
-            self.root.after(0, lambda: self.on_action_complete(False, str(e)))
+            # `e` is unbound once the except block ends, before the callback runs
+            msg = str(e)
+            self.root.after(0, lambda: self.on_action_complete(False, msg))
+
+    def on_convert_page(self, done, total):
+        if self.cancel_token is None or self.cancel_token.cancelled:
+            return
+        self.progress.config(value=100.0 * done / total)
+        self.detail_label.config(text=f"{done} of {total} pages converted")
+        if done == total:
+            self.status_label.config(text="Writing Word file...")
 
     def on_action_complete(self, success, message):
+        """
+        success is True/False for finished/failed jobs and None for cancelled ones.
+        """
         self.progress.stop()
+        self.progress.config(value=0)
+        self.cancel_token = None
+        self.cancel_btn.pack_forget()
+        self.cancel_btn.config(state="normal")
+        self.detail_label.config(text="")
         self.start_btn.config(state="normal")
         self.status_label.config(text="Ready to start...", fg="#495057")
-        if success:
+        if success is None:
+            messagebox.showinfo("Cancelled", message)
+        elif success:
             messagebox.showinfo("Done", message)
         else:
             messagebox.showerror("Error", message)
@@ -1,6 +1,7 @@
 import subprocess
 import os
 import sys
+import json
 import tkinter as tk
 from tkinter import messagebox
 import logging
@@ -19,8 +20,40 @@ logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 
+# Interpreter found by the last launch, so later launches skip the probing
+cache_file = os.path.join(base_dir, 'launcher_cache.json')
+
+def get_cached_python_executable():
+    """Returns the cached interpreter path if it still exists, else None."""
+    try:
+        with open(cache_file, encoding='utf-8') as f:
+            cached = json.load(f).get("python")
+    except (OSError, ValueError, AttributeError):
+        return None
+    if cached and os.path.exists(cached):
+        logging.info(f"Using cached python: {cached}")
+        return cached
+    return None
+
+def save_python_executable(python_exe):
+    try:
+        with open(cache_file, 'w', encoding='utf-8') as f:
+            json.dump({"python": python_exe}, f)
+    except OSError as e:
+        logging.warning(f"Could not cache python path: {str(e)}")
+
 def get_python_executable():
     """Tries to find the pythonw or python executable."""
+    cached = get_cached_python_executable()
+    if cached:
+        return cached
+    python_exe = find_python_executable()
+    if python_exe:
+        save_python_executable(python_exe)
+    return python_exe
+
+def find_python_executable():
+    """Probes the known locations for the pythonw or python executable."""
     logging.debug("Starting python discovery")
     candidates = [
         os.path.join(os.path.dirname(sys.executable), "pythonw.exe"),
@@ -52,6 +85,15 @@ def launch():
         logging.debug("Running as script")
     
     logging.info(f"Base Directory: {base_dir}")
+
+    # Office Tools is already open: it raises its window, no new interpreter needed
+    try:
+        from single_instance import notify_running
+        if notify_running():
+            logging.info("Handed over to the running instance")
+            return
+    except ImportError as e:
+        logging.warning(f"Single-instance check unavailable: {str(e)}")
     
     script_path = os.path.join(base_dir, "Office Tools.py")
     python_exe = get_python_executable()
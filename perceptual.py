@@ -0,0 +1,164 @@
+"""
+Perceptual quality scoring and per-image byte budgeting for the compressor's
+perceptual search modes. Requires NumPy.
+
+Images are compared on their luma plane, over a grid of TILE_SIDE pixel tiles
+taken at the original's own resolution, so the score sees the detail that
+downscaling removes. Scoring a candidate still means decoding it and resampling
+its tiles, which costs about as much as encoding it; the statistics of the
+originals are computed once per search.
+"""
+import heapq
+import numpy as np
+from PIL import Image
+
+# Side, in original pixels, of the tiles that get compared, and tiles per row and column
+TILE_SIDE = 256
+TILE_GRID = 3
+# SSIM window side, and the step between windows (every pixel is still covered)
+SSIM_WINDOW = 7
+SSIM_STRIDE = 2
+
+def _spread(room, count):
+    if room <= 0 or count <= 1:
+        return [max(0, room) // 2]
+    return sorted({round(room * i / (count - 1)) for i in range(count)})
+
+def tile_boxes(width, height, side=TILE_SIDE, grid=TILE_GRID):
+    """
+    Up to grid x grid boxes of side x side pixels spread evenly over a width x height
+    image, edges included. An image smaller than a tile is a single box.
+    """
+    tile_w, tile_h = min(side, width), min(side, height)
+    return [(x, y, x + tile_w, y + tile_h)
+            for y in _spread(height - tile_h, grid) for x in _spread(width - tile_w, grid)]
+
+def _luma(img):
+    if img.format == "JPEG":
+        img.draft("L", img.size)  # decode luma only, at full size; no-op once loaded
+    if img.mode not in ("L", "RGB"):
+        has_alpha = "A" in img.getbands() or "transparency" in img.info
+        img = img.convert("RGBA").convert("RGB") if has_alpha else img.convert("RGB")
+    return img.convert("L")
+
+def luma_tiles(img, boxes, size=None):
+    """
+    Luma of `boxes` (in the coordinates of an original of `size`, default img.size)
+    as float32 arrays at the boxes' native size. Candidates encoded at a smaller
+    scale have their boxes mapped onto them and resampled back up, so the score
+    includes the detail lost to downscaling.
+    """
+    img = _luma(img)
+    size = size or img.size
+    sx, sy = img.width / size[0], img.height / size[1]
+    tiles = []
+    for x0, y0, x1, y1 in boxes:
+        if img.size == tuple(size):
+            tile = img.crop((x0, y0, x1, y1))
+        else:
+            tile = img.resize((x1 - x0, y1 - y0), Image.Resampling.BILINEAR,
+                              box=(x0 * sx, y0 * sy, x1 * sx, y1 * sy))
+        tiles.append(np.asarray(tile, dtype=np.float32))
+    return tiles
+
+def _box_mean(a, win, stride):
+    # Mean of the win x win windows starting every `stride` pixels, as running sums
+    # of shifted slices down the columns and then along the rows, in float32
+    h, w = a.shape
+    rows = a[:h - win + 1:stride].astype(np.float32)
+    for i in range(1, win):
+        rows += a[i:h - win + 1 + i:stride]
+    out = rows[:, :w - win + 1:stride].copy()
+    for i in range(1, win):
+        out += rows[:, i:w - win + 1 + i:stride]
+    out *= 1.0 / (win * win)
+    return out
+
+def _stats(x, win, data_range):
+    # Everything the SSIM of x against any candidate needs from x alone
+    win = max(1, min(win, x.shape[0], x.shape[1]))
+    stride = min(SSIM_STRIDE, win)
+    c1, c2 = (0.01 * data_range) ** 2, (0.03 * data_range) ** 2
+    mu = _box_mean(x, win, stride)
+    var = _box_mean(x * x, win, stride) - mu * mu
+    return x, win, stride, mu, mu * mu + c1, var + c2, c1, c2
+
+def _ssim(reference, y):
+    x, win, stride, mu_x, luminance, contrast, c1, c2 = reference
+    mu_y = _box_mean(y, win, stride)
+    mu_yy = mu_y * mu_y
+    mu_xy = mu_x * mu_y
+    var_y = _box_mean(y * y, win, stride) - mu_yy
+    cov = _box_mean(x * y, win, stride) - mu_xy
+    ssim_map = (2 * mu_xy + c1) * (2 * cov + c2) / ((luminance + mu_yy) * (contrast + var_y))
+    return float(ssim_map.mean())
+
+def ssim(x, y, win=SSIM_WINDOW, data_range=255.0):
+    """
+    Mean structural similarity of two equally sized luma planes (uniform window).
+    """
+    return _ssim(_stats(x, win, data_range), y)
+
+def reference_tiles(tiles, win=SSIM_WINDOW, data_range=255.0):
+    """
+    Prepares an original's tiles from luma_tiles for tile_ssim: their local means
+    and variances are computed once here instead of for every candidate.
+    """
+    return [_stats(x, win, data_range) for x in tiles]
+
+def tile_ssim(reference, candidate):
+    """
+    Mean SSIM of a candidate's tiles from luma_tiles against the matching
+    reference_tiles of the original.
+    """
+    return sum(_ssim(x, y) for x, y in zip(reference, candidate)) / len(reference)
+
+def _frontier(options):
+    """
+    Upper concave hull of (size, score, params) options, ordered from the largest,
+    best-scoring option down. Stepping along it always gives up the least score
+    per byte saved first.
+    """
+    points = sorted(options, key=lambda o: (o[0], -o[1]))
+    hull = []
+    for point in points:
+        if hull and point[1] <= hull[-1][1]:
+            continue  # larger but not better: dominated
+        while len(hull) >= 2:
+            (s1, q1, _), (s2, q2, _) = hull[-2], hull[-1]
+            # Drop the middle point when it lies on or below the chord
+            if (q2 - q1) * (point[0] - s1) <= (point[1] - q1) * (s2 - s1):
+                hull.pop()
+            else:
+                break
+        hull.append(point)
+    return hull[::-1]
+
+def allocate(candidates, budget):
+    """
+    Picks one option per image so the total size fits `budget` with the highest
+    total score. `candidates` maps an image key to (size, score, params) options;
+    returns ({key: chosen option}, fits). Large images that compress well give up
+    bytes first because they lose the least score per byte saved.
+    """
+    frontiers = {key: _frontier(options) for key, options in candidates.items()}
+    position = dict.fromkeys(frontiers, 0)
+    total = sum(frontier[0][0] for frontier in frontiers.values())
+
+    def push(heap, key):
+        frontier, i = frontiers[key], position[key]
+        if i + 1 < len(frontier):
+            saved = frontier[i][0] - frontier[i + 1][0]
+            lost = frontier[i][1] - frontier[i + 1][1]
+            heapq.heappush(heap, (lost / saved, key))
+
+    heap = []
+    for key in frontiers:
+        push(heap, key)
+    while total > budget and heap:
+        _, key = heapq.heappop(heap)
+        i = position[key]
+        total -= frontiers[key][i][0] - frontiers[key][i + 1][0]
+        position[key] = i + 1
+        push(heap, key)
+    return {key: frontiers[key][position[key]] for key in frontiers}, total <= budget
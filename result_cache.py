@@ -0,0 +1,121 @@
+import os
+import json
+import glob
+import shutil
+import hashlib
+import tempfile
+
+# Default size cap for the on-disk result cache
+RESULT_CACHE_BYTES = 2 * 1024 * 1024 * 1024
+
+def file_digest(path, chunk_size=1024 * 1024):
+    """
+    SHA-256 of a file's content, read in chunks.
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+class ResultCache:
+    """
+    Content-addressed on-disk cache of compression results.
+
+    Entries are keyed by (input content hash, file type, target size in bytes) and
+    hold the compressed output plus a JSON record with the winning quality/scale.
+    Files are written to a temp name and moved into place with os.replace, so
+    several batch workers can share one directory. Reads refresh an entry's mtime,
+    which is the LRU order used to stay under max_bytes.
+    """
+    def __init__(self, directory, max_bytes=RESULT_CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def _entry_path(self, digest, file_type, target_size_mb):
+        target_bytes = int(target_size_mb * 1024 * 1024)
+        return os.path.join(self.directory, digest[:2], f"{digest}-{file_type}-{target_bytes}")
+
+    def lookup(self, digest, file_type, target_size_mb):
+        """
+        Returns (cached output path, record) for an exact hit, or None.
+        """
+        base = self._entry_path(digest, file_type, target_size_mb)
+        try:
+            with open(base + ".json", encoding="utf-8") as f:
+                record = json.load(f)
+            os.utime(base + ".json")
+            os.utime(base + ".bin")
+        except (OSError, ValueError):
+            return None
+        return base + ".bin", record
+
+    def nearest(self, digest, file_type, target_size_mb):
+        """
+        Returns the record cached for the same input and type whose target is closest
+        to target_size_mb, or None. Used to seed the search for near-miss targets.
+        """
+        pattern = os.path.join(self.directory, digest[:2], f"{digest}-{file_type}-*.json")
+        best = None
+        for meta_path in glob.glob(pattern):
+            try:
+                with open(meta_path, encoding="utf-8") as f:
+                    record = json.load(f)
+            except (OSError, ValueError):
+                continue
+            distance = abs(record["target_size_mb"] - target_size_mb)
+            if best is None or distance < best[0]:
+                best = (distance, record)
+        return best[1] if best else None
+
+    def store(self, digest, file_type, target_size_mb, output_path, record):
+        """
+        Atomically adds a result (output file + JSON record) and evicts old entries.
+        """
+        base = self._entry_path(digest, file_type, target_size_mb)
+        folder = os.path.dirname(base)
+        os.makedirs(folder, exist_ok=True)
+
+        fd, tmp_bin = tempfile.mkstemp(dir=folder, suffix=".tmp")
+        os.close(fd)
+        try:
+            shutil.copyfile(output_path, tmp_bin)
+            os.replace(tmp_bin, base + ".bin")
+        except OSError:
+            if os.path.exists(tmp_bin):
+                os.remove(tmp_bin)
+            raise
+
+        # The record is written last: a reader never sees JSON without its output
+        fd, tmp_json = tempfile.mkstemp(dir=folder, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(dict(record, target_size_mb=target_size_mb), f)
+        os.replace(tmp_json, base + ".json")
+        self.evict()
+
+    def evict(self):
+        """
+        Removes least recently used entries until the cache fits in max_bytes.
+        """
+        entries = []
+        total = 0
+        for meta_path in glob.glob(os.path.join(self.directory, "*", "*.json")):
+            base = meta_path[:-len(".json")]
+            try:
+                size = os.path.getsize(base + ".bin") + os.path.getsize(meta_path)
+                used = os.path.getmtime(meta_path)
+            except OSError:
+                continue
+            entries.append((used, size, base))
+            total += size
+
+        for used, size, base in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            for path in (base + ".json", base + ".bin"):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total -= size
@@ -0,0 +1,165 @@
+"""
+Single-instance support for the GUI.
+
+The first Office Tools process of a user holds a lock file in that user's profile
+and listens on an ephemeral localhost port recorded next to it. Later launches by
+the same user see the lock is taken, connect to that port, hand over their request
+and exit, so a click on the launcher raises the window that is already open
+instead of starting a new interpreter. When the lock is free no connection is
+attempted at all, so a cold start never waits on a closed port.
+"""
+import os
+import json
+import socket
+import secrets
+import tempfile
+import threading
+import logging
+
+INSTANCE_HOST = "127.0.0.1"
+LOCK_NAME = "instance.lock"
+ENDPOINT_NAME = "instance.json"
+# Sent back by a running instance, so an unrelated program on the port is never mistaken for one
+_GREETING = b"office-tools\n"
+# Seconds a client waits for the running instance to answer
+CONNECT_TIMEOUT = 0.5
+
+def default_state_dir():
+    """
+    Per-user directory for the lock and endpoint files: %LOCALAPPDATA% on Windows,
+    $XDG_RUNTIME_DIR or ~/.cache elsewhere.
+    """
+    base = (os.environ.get("LOCALAPPDATA") or os.environ.get("XDG_RUNTIME_DIR")
+            or os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(base, "office_tools")
+
+def _try_lock(f):
+    """
+    Takes a non-blocking exclusive lock on an open file. Returns False if another
+    process holds it. The OS drops the lock when its holder exits, even on a crash.
+    """
+    try:
+        if os.name == "nt":
+            import msvcrt
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return False
+    return True
+
+def _instance_running(state_dir):
+    try:
+        f = open(os.path.join(state_dir, LOCK_NAME), "rb")
+    except OSError:
+        return False  # no instance has ever run
+    with f:
+        # Closing the file releases the probe's own lock
+        return not _try_lock(f)
+
+def notify_running(message="show", state_dir=None, timeout=CONNECT_TIMEOUT):
+    """
+    Hands `message` to this user's running instance. Returns True if one accepted
+    it, False if none is running; that case only checks the lock file.
+    """
+    state_dir = state_dir or default_state_dir()
+    if not _instance_running(state_dir):
+        return False
+    try:
+        with open(os.path.join(state_dir, ENDPOINT_NAME), encoding="utf-8") as f:
+            endpoint = json.load(f)
+        with socket.create_connection((INSTANCE_HOST, endpoint["port"]), timeout=timeout) as conn:
+            conn.sendall(f"{endpoint['token']}\n{message}\n".encode("utf-8"))
+            reply = conn.makefile("rb").readline()
+    except (OSError, ValueError, KeyError, TypeError):
+        return False
+    return reply == _GREETING
+
+class InstanceServer:
+    """
+    Accepts requests from later launches on a daemon thread and passes each one to
+    on_request(message). The callback runs on the server thread; GUI code should
+    hand it over to the Tk thread with root.after.
+
+    Requests must carry the token written to the endpoint file, which only this
+    user can read, so other users on the same machine cannot reach the window.
+    """
+    def __init__(self, on_request, state_dir=None):
+        self.on_request = on_request
+        self.state_dir = state_dir or default_state_dir()
+        self.port = None
+        self._token = secrets.token_hex(16)
+        self._sock = None
+        self._lock_file = None
+
+    def start(self):
+        """
+        Takes the lock and starts listening. Returns False if another instance of
+        this user holds the lock (it won a race) or the files cannot be written;
+        the app then runs on its own.
+        """
+        try:
+            os.makedirs(self.state_dir, exist_ok=True)
+            lock_file = open(os.path.join(self.state_dir, LOCK_NAME), "a+b")
+        except OSError:
+            return False
+        if not _try_lock(lock_file):
+            lock_file.close()
+            return False
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.bind((INSTANCE_HOST, 0))
+            sock.listen(4)
+            self.port = sock.getsockname()[1]
+            self._write_endpoint()
+        except OSError:
+            sock.close()
+            lock_file.close()
+            return False
+        self._sock, self._lock_file = sock, lock_file
+        threading.Thread(target=self._serve, daemon=True).start()
+        return True
+
+    def _write_endpoint(self):
+        # Written to a temp name and moved into place, so a client never reads half a file
+        fd, tmp_path = tempfile.mkstemp(dir=self.state_dir, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({"port": self.port, "token": self._token}, f)
+        os.replace(tmp_path, os.path.join(self.state_dir, ENDPOINT_NAME))
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self._sock.accept()
+            except OSError:
+                return  # closed
+            with conn:
+                try:
+                    conn.settimeout(CONNECT_TIMEOUT)
+                    # The reader is closed here, so the connection really closes on a rejected token
+                    with conn.makefile("rb") as lines:
+                        token = lines.readline().strip()
+                        message = lines.readline().decode("utf-8").strip()
+                    if not secrets.compare_digest(token, self._token.encode("ascii")):
+                        continue
+                    conn.sendall(_GREETING)
+                except (OSError, UnicodeDecodeError):
+                    continue
+            try:
+                self.on_request(message)
+            except Exception as e:
+                logging.error("Single-instance request %r failed: %s", message, e)
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+        if self._lock_file is not None:
+            try:
+                os.remove(os.path.join(self.state_dir, ENDPOINT_NAME))
+            except OSError:
+                pass
+            self._lock_file.close()
+            self._lock_file = None
@@ -1,37 +1,147 @@
 import os
+import io
+import random
 from PIL import Image
-from compressor import compress_pdf, compress_office_doc, get_file_size_mb, iterative_compress
+from compressor import compress_pdf, get_file_size_mb, iterative_compress
 import zipfile
 
-def create_test_image(path, size=(1000, 1000), color='red'):
-    img = Image.new('RGB', size, color=color)
-    img.save(path, quality=100)
+def create_test_image(path, size=(1000, 1000), color='red', noise=False, seed=0, fmt=None):
+    """
+    Writes a solid image, or with noise=True a reproducible photo-like image
+    (smooth random gradients plus fine grain) that compresses like a photograph.
+    """
+    if noise:
+        rng = random.Random(seed)
+        w, h = size
+        cw, ch = max(1, w // 16), max(1, h // 16)
+        coarse = Image.frombytes('RGB', (cw, ch), rng.randbytes(cw * ch * 3))
+        img = coarse.resize(size, Image.Resampling.BICUBIC)
+        grain = Image.frombytes('RGB', size, rng.randbytes(w * h * 3))
+        img = Image.blend(img, grain, 0.12)
+    else:
+        img = Image.new('RGB', size, color=color)
+    img.save(path, format=fmt, quality=100)
     return os.path.getsize(path)
 
-def create_test_pdf(path, image_path):
+def create_test_pdf(path, image_path, pages=1, shared=True):
+    """
+    Writes a PDF showing image_path (or each of a list of images) on `pages` pages.
+    With shared=True, pages repeating an image reference a single XObject.
+    """
     from pypdf import PdfWriter, PdfReader
-    # Extremely simple PDF with one image
-    img = Image.open(image_path)
-    img.save("temp_page.pdf")
-    # Actually, simpler to just use Pillow to save as PDF
-    img.save(path, "PDF", resolution=100.0)
+    image_paths = image_path if isinstance(image_path, (list, tuple)) else [image_path]
+    if pages == 1 and len(image_paths) == 1:
+        # Extremely simple PDF with one image
+        img = Image.open(image_paths[0])
+        img.save("temp_page.pdf")
+        # Actually, simpler to just use Pillow to save as PDF
+        img.save(path, "PDF", resolution=100.0)
+        return os.path.getsize(path)
+
+    readers = []
+    for p in image_paths:
+        buf = io.BytesIO()
+        Image.open(p).convert('RGB').save(buf, "PDF", resolution=100.0)
+        readers.append(PdfReader(buf))
+    writer = PdfWriter()
+    for n in range(pages):
+        if shared:
+            writer.add_page(readers[n % len(readers)].pages[0])
+        else:
+            writer.append(readers[n % len(readers)])
+    with open(path, "wb") as f:
+        writer.write(f)
     return os.path.getsize(path)
 
-def create_test_docx(path, image_path):
-    # Manually create a minimal docx (ZIP with word/media/image1.png)
-    temp_dir = "temp_docx_build"
-    os.makedirs(os.path.join(temp_dir, "word", "media"), exist_ok=True)
-    import shutil
-    shutil.copy(image_path, os.path.join(temp_dir, "word", "media", "image1.png"))
-    
-    # Create [Content_Types].xml and other minimal structures if needed, 
-    # but for our compressor, we just need the ZIP structure word/media/
-    with zipfile.ZipFile(path, 'w') as zipf:
-        zipf.write(os.path.join(temp_dir, "word", "media", "image1.png"), "word/media/image1.png")
-    
-    shutil.rmtree(temp_dir)
+_CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Default Extension="png" ContentType="image/png"/>'
+    '<Default Extension="jpeg" ContentType="image/jpeg"/>'
+    '<Default Extension="jpg" ContentType="image/jpeg"/>'
+    '{overrides}</Types>'
+)
+_IMAGE_REL = ('<Relationship Id="rId{n}" Target="{target}" '
+              'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/image"/>')
+
+def _write_package(path, parts):
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        for name, data in parts:
+            zipf.writestr(name, data)
     return os.path.getsize(path)
 
+def create_test_docx(path, image_path, paragraphs=0):
+    """
+    Writes a docx holding image_path (or each of a list of images) as word/media/imageN.
+    A single image keeps the original minimal layout; several images get a full package
+    with [Content_Types].xml, document.xml and relationships.
+    """
+    if not isinstance(image_path, (list, tuple)):
+        # Manually create a minimal docx (ZIP with word/media/image1.png)
+        # for our compressor, we just need the ZIP structure word/media/
+        with zipfile.ZipFile(path, 'w') as zipf:
+            zipf.write(image_path, "word/media/image1.png")
+        return os.path.getsize(path)
+
+    parts, rels, body = [], [], []
+    for n, p in enumerate(image_path, 1):
+        name = f"image{n}{os.path.splitext(p)[1].lower()}"
+        with open(p, 'rb') as f:
+            parts.append((f"word/media/{name}", f.read()))
+        rels.append(_IMAGE_REL.format(n=n, target=f"media/{name}"))
+        body.append(f'<w:p><w:r><w:drawing><a:blip r:embed="rId{n}"/></w:drawing></w:r></w:p>')
+    body.extend(f'<w:p><w:r><w:t>Paragraph {n} of generated filler text.</w:t></w:r></w:p>'
+                for n in range(paragraphs))
+    document = ('<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main" '
+                'xmlns:a="http://schemas.openxmlformats.org/drawingml/2006/main" '
+                'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+                f'<w:body>{"".join(body)}</w:body></w:document>')
+    override = ('<Override PartName="/word/document.xml" ContentType="application/'
+                'vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>')
+    return _write_package(path, [
+        ("[Content_Types].xml", _CONTENT_TYPES.format(overrides=override)),
+        ("word/document.xml", document),
+        ("word/_rels/document.xml.rels",
+         '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+         f'{"".join(rels)}</Relationships>'),
+    ] + parts)
+
+def create_test_xlsx(path, image_paths, charts=1, rows=200):
+    """
+    Writes an xlsx with a data sheet, `charts` chart parts and the given images
+    placed through xl/drawings/drawing1.xml.
+    """
+    parts, rels = [], []
+    for n, p in enumerate(image_paths, 1):
+        name = f"image{n}{os.path.splitext(p)[1].lower()}"
+        with open(p, 'rb') as f:
+            parts.append((f"xl/media/{name}", f.read()))
+        rels.append(_IMAGE_REL.format(n=n, target=f"../media/{name}"))
+    for n in range(1, charts + 1):
+        series = "".join(f'<c:pt idx="{i}"><c:v>{(i * 37 + n) % 101}</c:v></c:pt>' for i in range(rows))
+        parts.append((f"xl/charts/chart{n}.xml",
+                       '<c:chartSpace xmlns:c="http://schemas.openxmlformats.org/drawingml/2006/chart">'
+                       f'<c:chart><c:plotArea><c:lineChart><c:ser><c:val><c:numLit>{series}'
+                       '</c:numLit></c:val></c:ser></c:lineChart></c:plotArea></c:chart></c:chartSpace>'))
+    cells = "".join(f'<row r="{r}"><c r="A{r}"><v>{r}</v></c><c r="B{r}"><v>{(r * 37) % 101}</v></c></row>'
+                    for r in range(1, rows + 1))
+    override = ('<Override PartName="/xl/workbook.xml" ContentType="application/'
+                'vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>')
+    return _write_package(path, [
+        ("[Content_Types].xml", _CONTENT_TYPES.format(overrides=override)),
+        ("xl/workbook.xml", '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+                            '<sheets><sheet name="Data" sheetId="1"/></sheets></workbook>'),
+        ("xl/worksheets/sheet1.xml", '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+                                     f'<sheetData>{cells}</sheetData></worksheet>'),
+        ("xl/drawings/drawing1.xml", '<xdr:wsDr xmlns:xdr="http://schemas.openxmlformats.org/'
+                                     'drawingml/2006/spreadsheetDrawing"/>'),
+        ("xl/drawings/_rels/drawing1.xml.rels",
+         '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+         f'{"".join(rels)}</Relationships>'),
+    ] + parts)
+
 def test_compression():
     print("Starting tests...")
     
@@ -72,5 +182,591 @@ def test_compression():
     else:
         print("Tests FAILED: Size did not reduce.")
 
+def test_perceptual_allocation():
+    import numpy as np
+    from perceptual import allocate, ssim
+
+    plane = np.arange(64 * 64, dtype=np.float32).reshape(64, 64) % 255
+    assert ssim(plane, plane) > 0.999
+    assert ssim(plane, np.zeros_like(plane)) < 0.5
+
+    # The big, highly compressible image gives up bytes before the small one
+    candidates = {
+        "photo": [(1000, 1.0, "orig"), (300, 0.97, "q60"), (150, 0.9, "q30")],
+        "screenshot": [(200, 1.0, "orig"), (120, 0.8, "q60")],
+    }
+    chosen, fits = allocate(candidates, 500)
+    assert fits
+    assert chosen["photo"][2] == "q60" and chosen["screenshot"][2] == "orig"
+
+    # Tiles are compared at the original's resolution, so downscaling costs score
+    import tempfile
+    from compressor import encode_image
+    from perceptual import TILE_GRID, TILE_SIDE, luma_tiles, reference_tiles, tile_boxes, tile_ssim
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "photo.jpeg")
+        create_test_image(path, size=(1500, 1000), noise=True)
+        with open(path, 'rb') as f:
+            photo = f.read()
+    boxes = tile_boxes(1500, 1000)
+    assert len(boxes) == TILE_GRID ** 2 and boxes[-1] == (1500 - TILE_SIDE, 1000 - TILE_SIDE, 1500, 1000)
+    assert tile_boxes(100, 80) == [(0, 0, 100, 80)]
+    reference = reference_tiles(luma_tiles(Image.open(io.BytesIO(photo)), boxes))
+
+    def score(quality, scale):
+        with Image.open(io.BytesIO(encode_image(photo, quality, scale, "JPEG"))) as img:
+            return tile_ssim(reference, luma_tiles(img, boxes, (1500, 1000)))
+    assert score(65, 1.0) > score(85, 0.5) > score(85, 0.3)
+
+def test_png_transcoding():
+    import tempfile
+    from PIL import ImageDraw, ImageStat
+    from compressor import OfficePackage, encode_image
+
+    with tempfile.TemporaryDirectory() as tmp:
+        photo = os.path.join(tmp, "photo.png")
+        screenshot = os.path.join(tmp, "screenshot.png")
+        create_test_image(photo, size=(400, 300), noise=True, fmt="PNG")
+        img = Image.new('RGB', (400, 300), 'white')
+        ImageDraw.Draw(img).rectangle([20, 20, 200, 100], fill='navy')
+        img.save(screenshot)
+        docx = os.path.join(tmp, "in.docx")
+        create_test_docx(docx, [photo, screenshot])
+
+        # The opaque photo becomes a JPEG part; the flat screenshot stays PNG
+        package = OfficePackage(docx)
+        output = os.path.join(tmp, "out.docx")
+        package.write(output, package.encode_media(60, 1.0))
+        with zipfile.ZipFile(output) as zf:
+            names = zf.namelist()
+            rels = zf.read("word/_rels/document.xml.rels").decode()
+            with Image.open(io.BytesIO(zf.read("word/media/image1.jpeg"))) as out_img:
+                assert out_img.format == "JPEG"
+            with Image.open(io.BytesIO(zf.read("word/media/image2.png"))) as out_img:
+                assert out_img.mode == "P"
+        assert "word/media/image1.png" not in names
+        assert 'Target="media/image1.jpeg"' in rels and 'Target="media/image2.png"' in rels
+        assert os.path.getsize(output) < os.path.getsize(docx)
+
+        # Animated GIFs keep every frame and 16-bit images keep their depth: both stay untouched
+        animation = os.path.join(tmp, "animation.gif")
+        frames = [Image.effect_noise((200, 150), 40 + 20 * n).convert('P') for n in range(4)]
+        frames[0].save(animation, save_all=True, append_images=frames[1:], duration=100, loop=0)
+        deep = os.path.join(tmp, "deep.png")
+        gradient = Image.linear_gradient('L').resize((300, 200)).convert('I').point(lambda v: v * 257)
+        gradient.convert('I;16').save(deep)
+        docx = os.path.join(tmp, "frames.docx")
+        create_test_docx(docx, [animation, deep])
+        package = OfficePackage(docx)
+        encoded = package.encode_media(20, 0.5)
+        for part in package.media:
+            assert part.format is None and encoded[part.name].raw == part.raw
+        output = os.path.join(tmp, "frames_out.docx")
+        package.write(output, encoded)
+        with zipfile.ZipFile(output) as zf:
+            with Image.open(io.BytesIO(zf.read("word/media/image1.gif"))) as out_img:
+                assert out_img.n_frames == 4
+        # Where 16-bit samples must become 8-bit, they are scaled rather than clipped
+        with open(deep, 'rb') as f:
+            flat = Image.open(io.BytesIO(encode_image(f.read(), 50, fmt="PNG")))
+        assert flat.mode == "L" and 100 < ImageStat.Stat(flat).mean[0] < 155
+
+def test_zip_entry_policy():
+    import tempfile
+    from compressor import OfficePackage
+
+    with tempfile.TemporaryDirectory() as tmp:
+        photo = os.path.join(tmp, "photo.jpeg")
+        create_test_image(photo, size=(300, 200), noise=True)
+        with open(photo, 'rb') as f:
+            jpeg = f.read()
+        source = os.path.join(tmp, "in.xlsx")
+        _write_package(source, [
+            ("xl/workbook.xml", '<workbook>' + '<sheet/>' * 500 + '</workbook>'),
+            ("xl/media/image1.jpeg", jpeg),
+            ("[Content_Types].xml", _CONTENT_TYPES.format(overrides="")),
+        ])
+
+        package = OfficePackage(source)
+        output = os.path.join(tmp, "out.xlsx")
+        written = package.write(output, package.encode_media(50, 1.0))
+        assert written == package.trial_size(50, 1.0) == os.path.getsize(output)
+        with zipfile.ZipFile(output) as zf:
+            assert zf.testzip() is None
+            infos = zf.infolist()
+            assert [info.filename for info in infos] == [
+                "[Content_Types].xml", "xl/workbook.xml", "xl/media/image1.jpeg"]
+            assert infos[1].compress_type == zipfile.ZIP_DEFLATED
+            assert infos[2].compress_type == zipfile.ZIP_STORED
+
+        # Deflated parts are copied raw; stored ones are deflated, and `recompress` opts classes in
+        with zipfile.ZipFile(source, 'a') as zf:
+            zf.writestr("xl/styles.xml", '<styleSheet>' + '<font/>' * 500 + '</styleSheet>',
+                        compress_type=zipfile.ZIP_STORED)
+            strings = "".join(f"<si><t>Item {n * 7919 % 1009}</t></si>" for n in range(2000))
+            zf.writestr("xl/sharedStrings.xml", f"<sst>{strings}</sst>", compress_type=zipfile.ZIP_DEFLATED,
+                        compresslevel=1)
+        package = OfficePackage(source)
+        assert list(package.rewritten) == ["xl/styles.xml"]
+        assert package.rewritten["xl/styles.xml"].method == zipfile.ZIP_DEFLATED
+        assert "xl/sharedStrings.xml" in OfficePackage(source, recompress=("xml",)).rewritten
+
+def test_downscale_fast_path():
+    import tempfile
+    from compressor import RESAMPLE_FILTERS, encode_image
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "photo.jpeg")
+        create_test_image(path, size=(1203, 797), noise=True)
+        with open(path, 'rb') as f:
+            photo = f.read()
+    # Reduced-resolution decoding must still land on the exact requested size
+    for resample in RESAMPLE_FILTERS:
+        for scale in (0.5, 0.3, 0.1):
+            with Image.open(io.BytesIO(encode_image(photo, 60, scale, resample=resample))) as img:
+                assert img.size == (int(1203 * scale), int(797 * scale))
+
+def test_joint_search():
+    import math
+    from compressor import MAX_SEARCH_TRIALS, SEARCH_QUALITY_FLOOR, _joint_search
+
+    # Synthetic document: 50 KB of fixed parts plus media that grow
+    # exponentially with quality and linearly with pixel count
+    def size(quality, scale):
+        return 50_000 + 4_000_000 * math.exp((quality - 95) / 25) * scale * scale
+
+    for target in (3_000_000, 1_000_000, 300_000, 120_000):
+        calls = []
+        quality, scale, fitted = _joint_search(lambda q, s: calls.append((q, s)) or size(q, s), target, 50_000)
+        assert fitted <= target and fitted >= 0.9 * target
+        assert len(calls) <= 6 and len(calls) <= MAX_SEARCH_TRIALS
+        assert scale == 1.0 or quality == SEARCH_QUALITY_FLOOR
+
+def test_media_dedup():
+    import tempfile
+    from compressor import OfficePackage
+
+    with tempfile.TemporaryDirectory() as tmp:
+        logo = os.path.join(tmp, "logo.jpeg")
+        photo = os.path.join(tmp, "photo.jpeg")
+        create_test_image(logo, size=(200, 100), noise=True, seed=1)
+        create_test_image(photo, size=(300, 200), noise=True, seed=2)
+        source = os.path.join(tmp, "in.xlsx")
+        create_test_xlsx(source, [logo, photo, logo, logo], charts=0)
+
+        package = OfficePackage(source)
+        assert [part.name for part in package.media] == ["xl/media/image1.jpeg", "xl/media/image2.jpeg"]
+        output = os.path.join(tmp, "out.xlsx")
+        package.write(output, package.encode_media(70, 1.0))
+        with zipfile.ZipFile(output) as zf:
+            media = [name for name in zf.namelist() if "/media/" in name]
+            rels = zf.read("xl/drawings/_rels/drawing1.xml.rels").decode()
+        assert media == ["xl/media/image1.jpeg", "xl/media/image2.jpeg"]
+        assert rels.count('Target="../media/image1.jpeg"') == 3
+        assert 'image3' not in rels and 'image4' not in rels
+
+def test_stream_compress_pdf():
+    import tempfile
+    from pypdf import PdfReader
+    from compressor import stream_compress_pdf
+
+    with tempfile.TemporaryDirectory() as tmp:
+        images = []
+        for n in range(3):
+            images.append(os.path.join(tmp, f"scan{n}.jpeg"))
+            create_test_image(images[-1], size=(600, 800), noise=True, seed=n)
+        source = os.path.join(tmp, "in.pdf")
+        create_test_pdf(source, images, pages=3, shared=False)
+
+        # A one-byte ceiling forces one image per chunk
+        output = os.path.join(tmp, "out.pdf")
+        chunks = []
+        written = stream_compress_pdf(source, output, 50, 0.5, memory_limit=1,
+                                      on_object=lambda done, total: chunks.append((done, total)))
+        assert written == os.path.getsize(output) < os.path.getsize(source)
+        assert len(chunks) >= 3 and chunks[-1][0] == chunks[-1][1]
+        reader = PdfReader(output, strict=True)
+        assert len(reader.pages) == 3
+        assert reader.pages[2].images[0].image.size == (300, 400)
+
+def test_batch():
+    import csv
+    import json
+    import tempfile
+    from batch import collect_inputs, output_path_for, run_batch, write_report
+
+    with tempfile.TemporaryDirectory() as tmp:
+        image = os.path.join(tmp, "photo.jpeg")
+        create_test_image(image, size=(600, 400), noise=True)
+        for folder in ("a", "b"):
+            os.makedirs(os.path.join(tmp, "in", folder))
+            create_test_docx(os.path.join(tmp, "in", folder, "x.docx"), [image])
+        with open(os.path.join(tmp, "in", "a", "notes.txt"), "w") as f:
+            f.write("not compressible")
+
+        # Same-named files in different folders keep distinct output names
+        inputs = collect_inputs([os.path.join(tmp, "in", "**", "*.docx")])
+        assert [rel for _, rel in inputs] == [os.path.join("a", "x.docx"), os.path.join("b", "x.docx")]
+        flat = collect_inputs([os.path.join(tmp, "in", "a", "x.docx"), os.path.join(tmp, "in", "b", "x.docx")])
+        assert [rel for _, rel in flat] == ["x.docx", "x-2.docx"]
+
+        out_dir = os.path.join(tmp, "out")
+        jobs = [(path, output_path_for(rel, out_dir, "_compressed")) for path, rel in inputs]
+        target_mb = get_file_size_mb(jobs[0][0]) / 2
+        rows = run_batch(jobs, target_mb, workers=2)
+        assert [row["input"] for row in rows] == [src for src, _ in jobs]
+        for row, (_, dst) in zip(rows, jobs):
+            assert row["status"] == "target_met" and row["output"] == dst
+            assert os.path.getsize(dst) <= target_mb * 1024 * 1024
+
+        write_report(rows, os.path.join(tmp, "report.json"))
+        write_report(rows, os.path.join(tmp, "report.csv"))
+        with open(os.path.join(tmp, "report.json"), encoding="utf-8") as f:
+            assert json.load(f) == rows
+        with open(os.path.join(tmp, "report.csv"), newline="", encoding="utf-8") as f:
+            records = list(csv.DictReader(f))
+        assert [r["output"] for r in records] == [dst for _, dst in jobs]
+        assert all(r["status"] == "target_met" and float(r["final_kb"]) > 0 for r in records)
+
+def test_result_cache():
+    import glob
+    import tempfile
+    from compressor import compress_file
+    from result_cache import ResultCache, file_digest
+
+    with tempfile.TemporaryDirectory() as tmp:
+        images = []
+        for n in range(2):
+            images.append(os.path.join(tmp, f"photo{n}.jpeg"))
+            create_test_image(images[-1], size=(800, 600), noise=True, seed=n)
+        source = os.path.join(tmp, "in.docx")
+        create_test_docx(source, images)
+        target_mb = get_file_size_mb(source) * 0.3
+        cache = ResultCache(os.path.join(tmp, "cache"))
+
+        first = compress_file(source, os.path.join(tmp, "first.docx"), target_mb, result_cache=cache)
+        assert first.trials > 0 and not first.cache_hit
+
+        # Exact hit: the stored output is copied without a single trial
+        output = os.path.join(tmp, "hit.docx")
+        hit = compress_file(source, output, target_mb, result_cache=cache)
+        assert hit.cache_hit and hit.trials == 0 and (hit.quality, hit.scale) == (first.quality, first.scale)
+        with open(output, "rb") as a, open(os.path.join(tmp, "first.docx"), "rb") as b:
+            assert a.read() == b.read()
+
+        # Near miss: the closest cached target seeds the first trial
+        digest = file_digest(source)
+        assert cache.nearest(digest, "docx", target_mb * 1.02)["quality"] == first.quality
+        starts = []
+        near = compress_file(source, os.path.join(tmp, "near.docx"), target_mb * 1.02, result_cache=cache,
+                             progress=lambda e: e["event"] == "trial_start" and starts.append(e))
+        assert not near.cache_hit and (starts[0]["quality"], starts[0]["scale"]) == (first.quality, first.scale)
+
+        # A lookup that loses the race with another worker's eviction falls back to a search
+        class RacingCache(ResultCache):
+            def lookup(self, *args):
+                found = super().lookup(*args)
+                if found is not None:
+                    os.remove(found[0])
+                return found
+        raced = compress_file(source, os.path.join(tmp, "raced.docx"), target_mb,
+                              result_cache=RacingCache(cache.directory))
+        assert not raced.cache_hit and raced.trials > 0 and raced.found_fit
+
+        # Eviction drops the least recently used entry, not the one that was just read
+        small = ResultCache(os.path.join(tmp, "small"))
+        payload = os.path.join(tmp, "payload.bin")
+        with open(payload, "wb") as f:
+            f.write(b"x" * 1000)
+        record = {"quality": 50, "scale": 1.0, "found_fit": True, "status": "target_met"}
+        for n, target in enumerate((1.0, 2.0)):
+            small.store("ab" * 32, "docx", target, payload, record)
+            for meta in glob.glob(os.path.join(small.directory, "*", f"*-{int(target * 1024 * 1024)}.*")):
+                os.utime(meta, (1000 + n, 1000 + n))
+        assert small.lookup("ab" * 32, "docx", 1.0) is not None
+        small.max_bytes = 2500
+        small.store("ab" * 32, "docx", 3.0, payload, record)
+        kept = [small.lookup("ab" * 32, "docx", target) is not None for target in (1.0, 2.0, 3.0)]
+        assert kept == [True, False, True]
+        total = sum(os.path.getsize(path) for path in glob.glob(os.path.join(small.directory, "*", "*")))
+        assert total <= small.max_bytes
+
+def test_pdf_process_engine():
+    import tempfile
+    from compressor import PDF_PROCESS_MIN_IMAGES, PdfImageIndex
+
+    with tempfile.TemporaryDirectory() as tmp:
+        images = []
+        for n in range(PDF_PROCESS_MIN_IMAGES):
+            images.append(os.path.join(tmp, f"scan{n}.jpeg"))
+            create_test_image(images[-1], size=(160, 120), noise=True, seed=n)
+        source = os.path.join(tmp, "in.pdf")
+        create_test_pdf(source, images, pages=len(images), shared=False)
+
+        # Sharded workers produce the same streams as the threaded engine
+        with PdfImageIndex(source, processes=1) as threaded:
+            threaded.apply(50, 0.75)
+            expected = [image.target._data for image in threaded.images]
+        sharded = PdfImageIndex(source, processes=2)
+        spool_dir = sharded._spool_dir
+        try:
+            assert sharded._pool is not None and os.path.isdir(spool_dir)
+            sharded.apply(50, 0.75)
+            assert [image.target._data for image in sharded.images] == expected
+            assert os.listdir(spool_dir)
+        finally:
+            sharded.close()
+        assert not os.path.exists(spool_dir)
+
+        # Defaults stay on threads
+        with PdfImageIndex(source) as index:
+            assert index._pool is None
+
+def test_convert_page_range():
+    import tempfile
+    try:
+        import pdf2docx  # noqa: F401
+    except ImportError:
+        return  # PDF to Word is an optional feature
+    from compressor import CONVERT_SHARD_PAGES, convert_pdf_to_word
+
+    with tempfile.TemporaryDirectory() as tmp:
+        image = os.path.join(tmp, "page.png")
+        create_test_image(image, size=(300, 400))
+        source = os.path.join(tmp, "in.pdf")
+        create_test_pdf(source, image, pages=CONVERT_SHARD_PAGES + 4)
+
+        # Pages 2..end (zero-based start=1) on two workers: two shards, one docx section per page
+        for workers in (1, 2):
+            output = os.path.join(tmp, f"out{workers}.docx")
+            progress = []
+            convert_pdf_to_word(source, output, start=1, workers=workers,
+                                on_page=lambda done, total: progress.append((done, total)))
+            pages = CONVERT_SHARD_PAGES + 3
+            assert progress[-1] == (pages, pages)
+            assert [done for done, _ in progress] == sorted(done for done, _ in progress)
+            with zipfile.ZipFile(output) as zf:
+                assert zf.read("word/document.xml").count(b"<w:sectPr") == pages
+
+def test_lazy_startup():
+    import sys
+    import subprocess
+    # The GUI must come up without PIL, pypdf or pdf2docx; workflows import them on demand
+    probe = "import sys, gui; print(sorted(m for m in ('PIL', 'pypdf', 'pdf2docx', 'compressor') if m in sys.modules))"
+    out = subprocess.run([sys.executable, "-c", probe], capture_output=True, text=True, check=True,
+                         cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+    assert out.strip() == "[]"
+
+def test_single_instance():
+    import json
+    import socket
+    import tempfile
+    import threading
+    import time
+    from single_instance import ENDPOINT_NAME, InstanceServer, notify_running
+
+    with tempfile.TemporaryDirectory() as state_dir:
+        # Nothing running: answered from the lock file without connecting anywhere
+        started = time.perf_counter()
+        assert not notify_running(state_dir=state_dir)
+        assert time.perf_counter() - started < 0.1
+
+        received = []
+        handled = threading.Event()
+        server = InstanceServer(lambda message: (received.append(message), handled.set()), state_dir=state_dir)
+        assert server.start()
+        try:
+            assert not InstanceServer(lambda message: None, state_dir=state_dir).start()
+            assert notify_running("show", state_dir=state_dir)
+            assert handled.wait(2) and received == ["show"]
+
+            # A client without this user's token is ignored
+            with socket.create_connection(("127.0.0.1", server.port), timeout=2) as conn:
+                conn.sendall(b"wrong-token\nshow\n")
+                assert conn.makefile("rb").readline() == b""
+            with open(os.path.join(state_dir, ENDPOINT_NAME), encoding="utf-8") as f:
+                assert json.load(f)["port"] == server.port
+        finally:
+            server.close()
+        # Closing releases the lock: the next launch starts its own instance
+        assert not notify_running(state_dir=state_dir)
+        assert not os.path.exists(os.path.join(state_dir, ENDPOINT_NAME))
+        again = InstanceServer(lambda message: None, state_dir=state_dir)
+        assert again.start()
+        again.close()
+    assert received == ["show"]
+
+def test_preflight_analysis():
+    import tempfile
+    from compressor import OfficePackage, analyze_file, compress_file
+
+    with tempfile.TemporaryDirectory() as tmp:
+        images = []
+        for n in range(3):
+            images.append(os.path.join(tmp, f"photo{n}.jpeg"))
+            create_test_image(images[-1], size=(1200, 900), noise=True, seed=n)
+        source = os.path.join(tmp, "in.docx")
+        create_test_docx(source, images + [images[0]], paragraphs=50)
+
+        analysis = analyze_file(source)
+        assert len(analysis.images) == 3 and analysis.duplicates > 0
+        assert analysis.overhead + analysis.media + analysis.duplicates == analysis.size
+        floor = OfficePackage(source).trial_size(10, 0.2)
+        assert abs(analysis.min_size - floor) < 0.25 * floor
+
+        # An unreachable target costs one trial at the smallest settings, not a full search
+        result = compress_file(source, os.path.join(tmp, "out.docx"), floor / 2 / (1024 * 1024))
+        assert (result.trials, result.found_fit, result.quality, result.scale) == (1, False, 10, 0.2)
+        assert "smallest reachable" in result.message
+
+        pdf = os.path.join(tmp, "in.pdf")
+        create_test_pdf(pdf, images, pages=6, shared=True)
+        analysis = analyze_file(pdf)
+        assert len(analysis.images) == 3 and analysis.min_size < analysis.size
+        assert analysis.reachable(analysis.size) and not analysis.reachable(analysis.min_size / 2)
+
+        # Owner-restricted PDFs (empty user password) are analyzed and compressed like any other
+        from pypdf import PdfReader, PdfWriter
+        writer = PdfWriter(clone_from=PdfReader(pdf))
+        writer.encrypt(user_password="", owner_password="owner", algorithm="RC4-128")
+        restricted = os.path.join(tmp, "restricted.pdf")
+        writer.write(restricted)
+        assert len(analyze_file(restricted).images) == 3
+        result = compress_file(restricted, os.path.join(tmp, "out.pdf"), analysis.size / 2 / (1024 * 1024))
+        assert result.found_fit and result.estimated_min_mb is not None
+
+def test_time_budget():
+    import time
+    import tempfile
+    from compressor import compress_file
+
+    with tempfile.TemporaryDirectory() as tmp:
+        images = []
+        for n in range(3):
+            images.append(os.path.join(tmp, f"photo{n}.jpeg"))
+            create_test_image(images[-1], size=(800, 600), noise=True, seed=n)
+        source = os.path.join(tmp, "in.docx")
+        create_test_docx(source, images)
+        target_mb = get_file_size_mb(source) * 0.25
+
+        # The first fit spends the budget: the search stops there and keeps it
+        ends = []
+        def progress(event):
+            if event["event"] == "trial_end":
+                ends.append(event)
+                if event["fits"]:
+                    time.sleep(1.0)
+        output = os.path.join(tmp, "out.docx")
+        result = compress_file(source, output, target_mb, progress=progress, time_budget=1.0)
+        fit = ends[-1]
+        assert not ends[0]["fits"] and fit["fits"] and len(ends) == result.trials > 1
+        assert not result.converged and result.found_fit
+        assert (result.quality, result.scale) == (fit["quality"], fit["scale"])
+        assert abs(result.final_size_mb - fit["size_mb"]) < 1e-9
+        with zipfile.ZipFile(output) as zf:
+            assert zf.testzip() is None
+
+        # A budget spent before the first trial (here, during analysis) leaves a copy of the input
+        result = compress_file(source, output, target_mb, time_budget=0)
+        assert (result.converged, result.trials, result.found_fit) == (False, 0, False)
+        with open(source, "rb") as a, open(output, "rb") as b:
+            assert a.read() == b.read()
+
+def test_cancel_cleanup():
+    import glob
+    import tempfile
+    from compressor import CancelToken, CompressionCancelled, compress_file
+
+    with tempfile.TemporaryDirectory() as tmp:
+        images = []
+        for n in range(2):
+            images.append(os.path.join(tmp, f"photo{n}.jpeg"))
+            create_test_image(images[-1], size=(600, 400), noise=True, seed=n)
+        docx = os.path.join(tmp, "in.docx")
+        create_test_docx(docx, images)
+        pdf = os.path.join(tmp, "in.pdf")
+        create_test_pdf(pdf, images, pages=2)
+        out_dir = os.path.join(tmp, "out")
+        spool_root = os.path.join(tmp, "spool")
+        os.makedirs(out_dir)
+        os.makedirs(spool_root)
+
+        # Cancelling from a progress callback leaves neither an output nor any spool directory
+        saved_tempdir = tempfile.tempdir
+        tempfile.tempdir = spool_root
+        try:
+            for source, memory_limit in ((docx, None), (pdf, None), (pdf, 1)):
+                token = CancelToken()
+                def progress(event):
+                    if event["event"] == "trial_end":
+                        token.cancel()
+                output = os.path.join(out_dir, "out" + os.path.splitext(source)[1])
+                try:
+                    compress_file(source, output, get_file_size_mb(source) * 0.2, progress=progress,
+                                  cancel=token, memory_limit=memory_limit)
+                    raise AssertionError("compression was not cancelled")
+                except CompressionCancelled:
+                    pass
+                assert not os.path.exists(output)
+                for root in (out_dir, spool_root):
+                    assert glob.glob(os.path.join(root, "office_tools_*")) == []
+        finally:
+            tempfile.tempdir = saved_tempdir
+
+def test_shared_executor():
+    import threading
+    from compressor import parallel_map, shared_executor
+
+    # Nested calls from pool threads run inline instead of waiting on the pool they occupy
+    def outer(n):
+        return sum(parallel_map(lambda m: m * n, range(4)))
+    assert parallel_map(outer, range(64)) == [6 * n for n in range(64)]
+    assert shared_executor() is shared_executor()
+
+    def fail(n):
+        if n == 3:
+            raise ValueError(n)
+        return threading.current_thread().name
+    try:
+        parallel_map(fail, range(8))
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("error was swallowed")
+    assert all(name.startswith("office_tools") for name in parallel_map(fail, [0, 1, 2]))
+
+    # A forked child gets a working pool of its own, not the parent's threadless copy
+    import multiprocessing
+    if "fork" in multiprocessing.get_all_start_methods():
+        with multiprocessing.get_context("fork").Pool(1) as pool:
+            assert pool.apply_async(parallel_map, (abs, [-1, -2, -3])).get(timeout=30) == [1, 2, 3]
+
+def test_pixel_cache():
+    import tempfile
+    from compressor import PixelCache, encode_image
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "photo.jpeg")
+        create_test_image(path, size=(800, 600), noise=True)
+        with open(path, "rb") as f:
+            data = f.read()
+
+        # Every quality and scale after the first decode comes from the cache
+        pixels = PixelCache(64 * 1024 * 1024)
+        for scale in (1.0, 0.5, 0.5, 0.25):
+            for quality in (80, 40):
+                out = encode_image(data, quality, scale, "JPEG", pixels=pixels, key="photo")
+                assert Image.open(io.BytesIO(out)).size == (int(800 * scale), int(600 * scale))
+        assert pixels.decodes == 1 and pixels.current_bytes <= pixels.max_bytes
+
+        # Room for the original only: adding its level evicts it, and the budget holds
+        small = PixelCache(800 * 600 * 4)
+        encode_image(data, 60, 0.5, "JPEG", pixels=small, key="photo")
+        assert small.current_bytes <= small.max_bytes
+        # Originals larger than the budget take the uncached path without decoding
+        tiny = PixelCache(1024)
+        assert tiny.level("photo", (800, 600), 0.5, "lanczos", None) is None
+        assert Image.open(io.BytesIO(encode_image(data, 60, 0.5, "JPEG", pixels=tiny, key="photo"))).size == (400, 300)
+
 if __name__ == "__main__":
     test_compression()